@@ -0,0 +1,284 @@
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from profiling import peak_rss
+
+# Size of the synthetic cohort, every patient gets an ENF and one "New Session" folder of CMJ trials
+n_patients = 4
+trials_per_patient = 3
+quiet_time = 0.8  # Seconds of quiet standing before the jump, sets the trial duration
+n_extra_points = 20  # Markers on top of the model outputs main.py uses
+point_rate = 100
+analog_rate = 1000
+workers = None  # Processes for the cohort stage, None uses every core
+
+# Set to a folder to keep the generated cohort, None writes it to a temporary folder that is removed afterwards
+bench_dir = None
+
+
+# this function makes the COM velocity (m/s) and total vertical GRF (N) of one CMJ at the force plate rate.
+# Quiet standing, a dip to the lowest velocity, push off to takeoff, ballistic flight and a damped landing
+def cmj_curves(mass=75.0, quiet=0.8, takeoff_velocity=2.6, seed=0):
+    rng = np.random.default_rng(seed)
+    g = 9.81
+    dt = 1.0 / analog_rate
+    ratio = analog_rate // point_rate
+
+    key_times = [0, quiet, quiet + 0.35, quiet + 0.6, quiet + 0.9]
+    key_velocities = [0, 0, -1.1, 0, takeoff_velocity]
+    ground = np.interp(np.arange(0, key_times[-1], dt), key_times, key_velocities)
+    ground = np.convolve(np.pad(ground, 12, mode="edge"), np.ones(25) / 25, mode="valid")  # No dip at the ends
+    ground[-5:] = np.linspace(ground[-6], takeoff_velocity, 5)
+
+    flight = takeoff_velocity - g * np.arange(dt, 2 * takeoff_velocity / g, dt)
+    landing_time = np.arange(dt, 1.2, dt)
+    landing = np.interp(landing_time, [0, 0.25, 0.5, 1.2], [flight[-1], -0.4, 0.05, 0])
+
+    velocity = np.concatenate([ground, flight, landing])
+    velocity = velocity[:len(velocity) - len(velocity) % ratio]  # Whole mocap frames only
+    grf = mass * (np.gradient(velocity, dt) + g)
+    grf[len(ground):len(ground) + len(flight)] = 0
+    grf = np.clip(grf, 0, None) + rng.normal(0, 2, len(velocity))
+    return velocity, grf
+
+
+# this function writes one synthetic CMJ c3d with the model outputs and force plate channels read_c3d expects.
+# c3d.Writer builds the header and parameter section, the data section is written in one go from numpy since
+# Writer.write only supports unlabelled points. A negative point_scale stores floats, a positive one int16
+def write_trial(path, mass=75.0, quiet=0.8, extra_points=0, point_scale=-0.1, seed=0):
+    import c3d
+
+    ratio = analog_rate // point_rate
+    velocity, grf = cmj_curves(mass, quiet, seed=seed)
+    n_frames = len(velocity) // ratio
+    rng = np.random.default_rng(seed)
+
+    labels = ["CentreOfMass", "COMVelocity"]
+    for side in "LR":
+        for joint in ["Hip", "Knee", "Ankle"]:
+            labels += [side + joint + "Angles", side + joint + "Moment"]
+    labels += ["M%03d" % i for i in range(extra_points)]
+    points = rng.normal(0, 10, (n_frames, len(labels), 3))
+    velocity_mm = velocity[::ratio] * 1000
+    points[:, 1, 2] = velocity_mm
+    points[:, 0, 2] = 1000 + np.cumsum(velocity_mm) / point_rate
+    progress = np.linspace(0, 1, n_frames)
+    for k in range(2, 14):
+        points[:, k, 0] = 40 * np.sin(np.pi * progress * (1 + k / 7)) + k + rng.normal(0, 1, n_frames)
+
+    analog_labels = []
+    for plate in (1, 2):
+        analog_labels += ["Force.Fx%d" % plate, "Force.Fy%d" % plate, "Force.Fz%d" % plate,
+                          "Moment.Mx%d" % plate, "Moment.My%d" % plate, "Moment.Mz%d" % plate]
+    analog = rng.normal(0, 5, (n_frames * ratio, len(analog_labels)))
+    analog[:, 2] = -grf * 0.52  # Plates report the reaction force, read_c3d flips the sign back
+    analog[:, 8] = -grf * 0.48
+
+    writer = c3d.Writer(point_rate=point_rate, analog_rate=analog_rate, point_scale=point_scale)
+
+    def add(group, name, fmt, value, *dimensions):
+        values = list(value) if isinstance(value, (list, tuple, np.ndarray)) else [value]
+        group.add_param(name, desc="", bytes_per_element=struct.calcsize(fmt), dimensions=list(dimensions),
+                        bytes=struct.pack("<" + fmt * len(values), *values))
+
+    def add_str(group, name, strings):
+        width = max(len(s) for s in strings)
+        group.add_param(name, desc="", bytes_per_element=-1, dimensions=[width, len(strings)],
+                        bytes="".join(s.ljust(width) for s in strings).encode())
+
+    is_float = point_scale < 0
+    analog_scale = 1.0 if is_float else 0.5
+    group = writer.add_group(1, "POINT", "")
+    add(group, "USED", "H", len(labels))
+    add(group, "FRAMES", "H", n_frames)
+    add(group, "DATA_START", "H", 0)
+    add(group, "SCALE", "f", point_scale)
+    add(group, "RATE", "f", float(point_rate))
+    add_str(group, "LABELS", labels)
+    add_str(group, "DESCRIPTIONS", labels)
+    group = writer.add_group(2, "ANALOG", "")
+    add(group, "USED", "H", len(analog_labels))
+    add(group, "RATE", "f", float(analog_rate))
+    add(group, "GEN_SCALE", "f", 1.0)
+    add(group, "SCALE", "f", [analog_scale] * len(analog_labels), len(analog_labels))
+    add(group, "OFFSET", "h", [0] * len(analog_labels), len(analog_labels))
+    add_str(group, "LABELS", analog_labels)
+    add_str(group, "DESCRIPTIONS", analog_labels)
+    group = writer.add_group(3, "TRIAL", "")
+    add(group, "CAMERA_RATE", "f", float(point_rate))
+    group = writer.add_group(4, "FORCE_PLATFORM", "")
+    add(group, "USED", "H", 2)
+    corners = []
+    for x0 in (-600.0, 0.0):  # Two 600 x 400 mm plates side by side
+        for x, y in ((x0 + 600, 0), (x0, 0), (x0, 400), (x0 + 600, 400)):
+            corners += [x, y, 0.0]
+    add(group, "CORNERS", "f", corners, 3, 4, 2)
+    group = writer.add_group(5, "PROCESSING", "")
+    add(group, "BODYMASS", "f", mass, 1)
+    add(group, "HEIGHT", "f", 1800.0, 1)
+
+    blocks = writer.parameter_blocks()
+    writer.get("POINT:DATA_START").bytes = struct.pack("<H", 2 + blocks)
+    header = writer.header
+    header.data_block = 2 + blocks
+    header.frame_rate = float(point_rate)
+    header.first_frame = 1
+    header.last_frame = n_frames
+    header.point_count = len(labels)
+    header.analog_count = len(analog_labels) * ratio
+    header.analog_per_frame = ratio
+    header.scale_factor = float(np.float32(point_scale))
+
+    if is_float:
+        raw_points = np.zeros((n_frames, len(labels), 4), np.float32)
+        raw_points[..., :3] = points
+        raw_analog = analog.astype(np.float32)
+    else:
+        raw_points = np.zeros((n_frames, len(labels), 4), np.int16)
+        raw_points[..., :3] = np.round(points / point_scale)
+        raw_analog = np.round(analog / analog_scale).astype(np.int16)
+    body = np.concatenate([raw_points.reshape(n_frames, -1).view(np.uint8),
+                           raw_analog.reshape(n_frames, -1).view(np.uint8)], axis=1)
+
+    with open(path, "wb") as handle:
+        writer._write_metadata(handle)
+        handle.write(body.tobytes())
+        extra = handle.tell() % 512
+        if extra:
+            handle.write(b"\x00" * (512 - extra))
+    return path
+
+
+# this function lays a synthetic cohort out like the HT folder, with a single leg trial main.py should skip
+def make_cohort(root_dir, patients=4, trials=3, quiet=0.8, extra_points=0, point_scale=-0.1):
+    for patient in range(patients):
+        patient_dir = os.path.join(root_dir, "SYN %03d Retest" % patient)
+        session_dir = os.path.join(patient_dir, "New Session %d" % (patient + 1))
+        os.makedirs(session_dir, exist_ok=True)
+        with open(os.path.join(patient_dir, "SYN %03d.enf" % patient), "w") as file:
+            file.write("[TRIAL_INFO]\nINJURY={}\n".format("Right" if patient % 2 else "Left"))
+        for trial in range(trials):
+            write_trial(os.path.join(session_dir, "CMJ %d.c3d" % (trial + 1)), mass=65.0 + patient % 30,
+                        quiet=quiet, extra_points=extra_points, point_scale=point_scale, seed=patient * 1000 + trial)
+        write_trial(os.path.join(session_dir, "SL CMJ 1.c3d"), quiet=quiet, extra_points=extra_points,
+                    point_scale=point_scale, seed=patient)
+    return root_dir
+
+
+def _start():
+    return time.perf_counter(), peak_rss()
+
+
+def _stage(results, name, trials, start):
+    # The peak RSS only ever goes up over the process' (and its workers') life, so a stage's own use shows as how
+    # far it raised the peak, 0 when it stayed under the high-water mark of an earlier stage
+    start, start_peak = start
+    seconds = time.perf_counter() - start
+    peak = peak_rss()
+    results.append({"Stage": name, "Trials": trials, "Seconds": seconds,
+                    "Trials/sec": trials / seconds if seconds else float("inf"),
+                    "RSS peak growth (MB)": (peak - start_peak) / 2 ** 20 if peak is not None else None,
+                    "Process RSS peak (MB)": peak / 2 ** 20 if peak is not None else None})
+
+
+# this function times each stage of the pipeline over the cohort in root_dir and returns one row per stage
+def bench_pipeline(root_dir, workers=None):
+    import pandas as pd
+    import main
+    from cohort import run_cohort
+    from norm2frame import norm2frame, norm2frame_batch
+    from prefetch import prefetch
+    from segment_stats import reduce_segments
+    from segmentation import segment_cmj, phase_windows
+    from trial import read_trial
+
+    results = []
+    patient_paths = [os.path.join(root_dir, folder) for folder in sorted(os.listdir(root_dir))]
+    patient_paths = [path for path in patient_paths if os.path.isdir(path)]
+
+    start = _start()
+    files = []
+    injured_sides = []
+    for patient_path in patient_paths:
+        injured_side = main.getInjuredSide(patient_path)
+        patient_files = main.getFiles(patient_path)
+        files += patient_files
+        injured_sides += [injured_side] * len(patient_files)
+    _stage(results, "Discovery", len(files), start)
+
+    start = _start()
+    trials = [read_trial(file, points=main.mocap_channels, analogs=main.force_channels) for file in files]
+    _stage(results, "Decode", len(trials), start)
+
+    start = _start()
+    for file, data in prefetch(files, 4):
+        read_trial(file, points=main.mocap_channels, analogs=main.force_channels, data=data)
+    _stage(results, "Prefetched decode", len(files), start)
+
+    start = _start()
+    phases = [segment_cmj(trial.channel("COMVelocity_z") / 1000, trial.channel("Fz1") + trial.channel("Fz2"),
+                          trial.ratio) for trial in trials]
+    _stage(results, "Segmentation", len(trials), start)
+
+    start = _start()
+    for trial, trial_phases in zip(trials, phases):
+        mocap_windows, force_windows = phase_windows(trial_phases, trial.ratio)
+        reduce_segments(trial.mocap, mocap_windows[0])
+        reduce_segments(trial.grf, force_windows[0], dx=1.0 / trial.force_rate)
+    _stage(results, "Metrics", len(trials), start)
+
+    start = _start()
+    for trial in trials:
+        for column in range(trial.mocap.shape[1]):
+            norm2frame(trial.mocap[:, column], 101)
+    _stage(results, "Time normalisation", len(trials), start)
+
+    start = _start()
+    norm2frame_batch([trial.mocap for trial in trials], 101)
+    _stage(results, "Batched time normalisation", len(trials), start)
+
+    start = _start()
+    for file, injured_side in zip(files, injured_sides):
+        main.calcTrial(file, injured_side)
+    _stage(results, "calcTrial", len(files), start)
+
+    force_only = main.force_only
+    main.configure(force_only=True)
+    try:
+        start = _start()
+        for file, injured_side in zip(files, injured_sides):
+            main.calcTrial(file, injured_side)
+        _stage(results, "Force-only calcTrial", len(files), start)
+    finally:
+        main.configure(force_only=force_only)
+
+    start = _start()
+    run_cohort(root_dir, workers)
+    _stage(results, "Cohort", len(files), start)
+
+    return pd.DataFrame(results)
+
+
+def run_bench(patients=4, trials=3, quiet=0.8, extra_points=20, workers=None, root_dir=None):
+    keep = root_dir is not None
+    root_dir = root_dir or tempfile.mkdtemp(prefix="cmj_bench_")
+    try:
+        start = time.perf_counter()
+        make_cohort(root_dir, patients, trials, quiet, extra_points)
+        print("Generated {} trials in {:.2f} s".format(patients * (trials + 1), time.perf_counter() - start))
+        return bench_pipeline(root_dir, workers)
+    finally:
+        if not keep:
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    with pd.option_context("display.width", 120, "display.float_format", "{:.3f}".format):
+        print(run_bench(n_patients, trials_per_patient, quiet_time, n_extra_points, workers, bench_dir))
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from read_c3d import read_c3d
+
+# Hit/miss counters for this process, see cache_stats()
+_counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Running size of every cache_dir this process has written to, so a miss only rescans the cache once it is full.
+# Eviction then frees space down to evict_to of max_bytes, so a full cache is rescanned once per 10% of new entries
+# rather than on every miss. Entries written by other processes are picked up at the next rescan
+_sizes = {}
+evict_to = 0.9
+
+
+# this function wraps read_c3d with an on-disk cache of the decoded arrays
+def read_c3d_cached(file, cache_dir, max_bytes=2 * 1024 ** 3, **kwargs):
+    import numpy as np
+    import pandas as pd
+
+    if not kwargs.get("read_mocap", True) or not os.path.exists(file):
+        return read_c3d(file, **kwargs)
+
+    # Entries are keyed on the file identity and on the channel selection that was asked for
+    stat = os.stat(file)
+    key = json.dumps([os.path.abspath(file), stat.st_size, stat.st_mtime_ns, sorted(kwargs.items())], default=str)
+    entry_dir = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+    meta_path = os.path.join(entry_dir, "meta.json")
+
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as meta_file:
+            meta = json.load(meta_file)
+        os.utime(meta_path)  # Mark as recently used for the LRU eviction
+        _counters["hits"] += 1
+        # Copy-on-write maps, so callers can still modify the frames they get back
+        mocap_data = pd.DataFrame(np.load(os.path.join(entry_dir, "mocap.npy"), mmap_mode="c"),
+                                  columns=meta["mocap_labels"],
+                                  index=np.load(os.path.join(entry_dir, "mocap_index.npy")))
+        force_data = pd.DataFrame(np.load(os.path.join(entry_dir, "grf.npy"), mmap_mode="c"),
+                                  columns=meta["force_labels"],
+                                  index=np.load(os.path.join(entry_dir, "grf_index.npy")))
+        return {"MoCap": mocap_data, "GRF": force_data, "Info": meta["info"]}
+
+    _counters["misses"] += 1
+    data = read_c3d(file, **kwargs)
+    if "Error" in data:
+        return data  # Errors are not cached, the file may be fixed later
+
+    # Write to a temporary folder first and rename, so parallel runs never see half an entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp")
+    np.save(os.path.join(tmp_dir, "mocap.npy"), data["MoCap"].to_numpy())
+    np.save(os.path.join(tmp_dir, "mocap_index.npy"), data["MoCap"].index.to_numpy())
+    np.save(os.path.join(tmp_dir, "grf.npy"), data["GRF"].to_numpy())
+    np.save(os.path.join(tmp_dir, "grf_index.npy"), data["GRF"].index.to_numpy())
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as meta_file:
+        json.dump({"file": os.path.abspath(file),
+                   "mocap_labels": list(data["MoCap"].columns),
+                   "force_labels": list(data["GRF"].columns),
+                   "info": data["Info"]}, meta_file, default=str)
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)  # Another process stored the same entry first
+        return data
+
+    if cache_dir in _sizes:
+        _sizes[cache_dir] += _entry_size(entry_dir)
+    else:
+        _sizes[cache_dir] = sum(size for _, size, _ in _cache_entries(cache_dir))
+    if _sizes[cache_dir] > max_bytes:
+        evict_cache(cache_dir, int(max_bytes * evict_to))
+    return data
+
+
+def _cache_entries(cache_dir):
+    # (last used, bytes, path) for every complete entry
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for entry in os.scandir(cache_dir):
+        meta_path = os.path.join(entry.path, "meta.json")
+        if entry.name.startswith(".tmp") or not os.path.exists(meta_path):
+            continue
+        entries.append((os.stat(meta_path).st_mtime, _entry_size(entry.path), entry.path))
+    return entries
+
+
+def _entry_size(entry_dir):
+    return sum(f.stat().st_size for f in os.scandir(entry_dir))
+
+
+def evict_cache(cache_dir, max_bytes):
+    # Remove the least recently used entries until the cache fits in max_bytes
+    entries = sorted(_cache_entries(cache_dir))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        _counters["evictions"] += 1
+    _sizes[cache_dir] = total
+    return total
+
+
+def cache_stats(cache_dir):
+    entries = _cache_entries(cache_dir)
+    stats = {"entries": len(entries), "bytes": sum(size for _, size, _ in entries)}
+    stats.update(_counters)
+    return stats
+
+
+def clear_cache(cache_dir):
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    _sizes.pop(cache_dir, None)
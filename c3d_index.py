@@ -0,0 +1,72 @@
+import json
+import os
+import sqlite3
+
+from read_c3d import read_c3d_info
+
+# Columns pulled out of the Info dict so cohort queries don't have to parse JSON
+index_columns = ["BODYMASS", "HEIGHT", "CAMERA_RATE", "FP_RATE", "xmidposFP1", "xmidposFP2"]
+
+
+def open_index(index_path):
+    connection = sqlite3.connect(index_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS trials ("
+        "path TEXT PRIMARY KEY, patient TEXT, session TEXT, trial TEXT, is_cmj INTEGER, "
+        "size INTEGER, mtime REAL, bodymass REAL, height REAL, camera_rate REAL, fp_rate REAL, "
+        "n_plates INTEGER, xmidposfp1 REAL, xmidposfp2 REAL, info TEXT, error TEXT)"
+    )
+    return connection
+
+
+def build_index(root_dir, index_path):
+    # Index the header/parameter info of every c3d under root_dir, only (re)reading files whose size or mtime changed
+    connection = open_index(index_path)
+    known = {path: (size, mtime) for path, size, mtime in connection.execute("SELECT path, size, mtime FROM trials")}
+    seen = set()
+    updated = 0
+
+    for (dirpath, dirnames, filenames) in os.walk(root_dir):
+        for filename in filenames:
+            if not filename.endswith(".c3d"):
+                continue
+            file_path = os.path.join(dirpath, filename)
+            stat = os.stat(file_path)
+            seen.add(file_path)
+            if known.get(file_path) == (stat.st_size, stat.st_mtime):
+                continue  # Unchanged since the last build
+
+            # Patient is the folder directly under the root, session the folder holding the trial
+            patient = os.path.relpath(file_path, root_dir).split(os.sep)[0]
+            session = os.path.basename(dirpath)
+            is_cmj = "CMJ" in filename and "SL" not in filename
+
+            data = read_c3d_info(file_path)
+            info = data.get("Info", {})
+            values = [info.get(column) for column in index_columns]
+            n_plates = len([key for key in info if key.startswith("xmidposFP")])
+
+            connection.execute(
+                "INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [file_path, patient, session, filename, int(is_cmj), stat.st_size, stat.st_mtime]
+                + values[:4] + [n_plates] + values[4:]
+                + [json.dumps(info, default=str), data.get("Error")],
+            )
+            updated += 1
+
+    # Drop files that have been removed from the root since the last build
+    removed = [path for path in known if path not in seen]
+    connection.executemany("DELETE FROM trials WHERE path = ?", [(path,) for path in removed])
+    connection.commit()
+    connection.close()
+    return {"indexed": len(seen), "updated": updated, "removed": len(removed)}
+
+
+def query_index(index_path, where="1", params=()):
+    # e.g. query_index(index_path, "is_cmj = 1 AND bodymass IS NOT NULL AND n_plates = 2")
+    import pandas as pd
+
+    connection = open_index(index_path)
+    trials = pd.read_sql_query("SELECT * FROM trials WHERE " + where, connection, params=params)
+    connection.close()
+    return trials
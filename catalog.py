@@ -0,0 +1,108 @@
+import json
+import os
+import sqlite3
+
+
+def open_catalog(catalog_path):
+    connection = sqlite3.connect(catalog_path)
+    connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime REAL, subdirs TEXT, "
+                       "files TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS enf (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                       "injured_side TEXT, fields TEXT)")
+    return connection
+
+
+def is_cmj(filename):
+    # Same rule as getFiles, single leg trials are left out
+    return filename.endswith(".c3d") and "CMJ" in filename and "SL" not in filename
+
+
+def read_enf(enf_path):
+    # Every KEY=value line of the ENF, plus the injured side exactly as getInjuredSide reads it
+    fields = {}
+    injured_side = None
+    with open(enf_path, "r") as file:
+        for line in file:
+            if line.startswith("INJURY=") and injured_side is None:
+                injured_side = line.split("=")[1].strip()
+            if "=" in line:
+                key, value = line.split("=", 1)
+                fields.setdefault(key.strip(), value.strip())
+    return injured_side, fields
+
+
+def build_catalog(root_dir, catalog_path):
+    # Patient -> sessions -> CMJ trials of every patient folder in root_dir, with their ENF fields. A directory is
+    # only listed again when its mtime changed (files added, removed or renamed in it), and an ENF only re-read when
+    # its size or mtime did, so a refresh of an unchanged root is one stat per directory
+    connection = open_catalog(catalog_path)
+    directories = {path: (mtime, json.loads(subdirs), json.loads(files)) for path, mtime, subdirs, files in
+                   connection.execute("SELECT path, mtime, subdirs, files FROM directories")}
+    enfs = {path: (size, mtime, injured_side, json.loads(fields)) for path, size, mtime, injured_side, fields in
+            connection.execute("SELECT path, size, mtime, injured_side, fields FROM enf")}
+    seen = set()
+    changed = []
+
+    def listing(path, mtime):
+        seen.add(path)
+        if path in directories and directories[path][0] == mtime:
+            return directories[path][1:]
+        subdirs, files = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                (subdirs if entry.is_dir() else files).append(entry.name)
+        directories[path] = (mtime, subdirs, files)
+        changed.append((path, mtime, json.dumps(subdirs), json.dumps(files)))
+        return subdirs, files
+
+    def sessions(path, mtime):
+        # Same order as getFiles: the "New Session" folders directly in path, then everything below them
+        subdirs = listing(path, mtime)[0]
+        children = [(os.path.join(path, name), os.stat(os.path.join(path, name)).st_mtime) for name in subdirs]
+        found = []
+        for child, child_mtime in children:
+            if "New Session" in os.path.basename(child):
+                trials = [os.path.join(child, name) for name in listing(child, child_mtime)[1] if is_cmj(name)]
+                found.append({"session": os.path.basename(child), "path": child, "trials": trials})
+        for child, child_mtime in children:
+            if not os.path.islink(child):  # Like os.walk, symlinked folders are listed but not descended into
+                found += sessions(child, child_mtime)
+        return found
+
+    def patient(patient_path):
+        patient_sessions = sessions(patient_path, os.stat(patient_path).st_mtime)
+
+        # First ENF in the folder, like getInjuredSide
+        injured_side, fields = None, None
+        enf_names = [name for name in directories[patient_path][2] if name.endswith(".enf")]
+        if enf_names:
+            enf_path = os.path.join(patient_path, enf_names[0])
+            stat = os.stat(enf_path)
+            seen.add(enf_path)
+            if enfs.get(enf_path, (None, None))[:2] != (stat.st_size, stat.st_mtime):
+                injured_side, fields = read_enf(enf_path)
+                enfs[enf_path] = (stat.st_size, stat.st_mtime, injured_side, fields)
+                connection.execute("INSERT OR REPLACE INTO enf VALUES (?, ?, ?, ?, ?)",
+                                   (enf_path, stat.st_size, stat.st_mtime, injured_side, json.dumps(fields)))
+            injured_side, fields = enfs[enf_path][2:]
+        return {"injured_side": injured_side, "enf": fields, "sessions": patient_sessions,
+                "trials": [trial for session in patient_sessions for trial in session["trials"]], "error": None}
+
+    catalog = []
+    for folder in listing(root_dir, os.stat(root_dir).st_mtime)[0]:
+        patient_path = os.path.join(root_dir, folder)
+        try:
+            entry = patient(patient_path)
+        except (OSError, UnicodeDecodeError) as err:  # A folder or ENF that can't be read only fails this patient
+            entry = {"injured_side": None, "enf": None, "sessions": [], "trials": [],
+                     "error": "{}: {}".format(type(err).__name__, err)}
+        catalog.append(dict({"patient": folder, "path": patient_path}, **entry))
+
+    # Store the directories listed this time and forget the ones that are gone
+    connection.executemany("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", changed)
+    connection.executemany("DELETE FROM directories WHERE path = ?",
+                           [(path,) for path in directories if path not in seen])
+    connection.executemany("DELETE FROM enf WHERE path = ?", [(path,) for path in enfs if path not in seen])
+    connection.commit()
+    connection.close()
+    return catalog
@@ -0,0 +1,143 @@
+import argparse
+import json
+
+# Command line entry point, e.g. "python cmj.py run /path/to/HT -o HT.xlsx -w 8". Every subcommand imports what it
+# needs when it runs, so index and info start without loading pandas, scipy or matplotlib
+
+
+def run(args):
+    import numpy as np
+    import main
+
+    settings = {"root_dir": args.root, "workers": args.workers, "output_table": args.table,
+                "cache_dir": args.cache_dir, "catalog_path": args.catalog, "manifest_path": args.manifest,
+                "results_dir": args.results_dir, "profile_path": args.profile, "prefetch_depth": args.prefetch,
+                "force_only": args.force_only or None}
+    if args.float32:
+        settings["trial_dtype"] = np.float32
+    main.configure(**{name: value for name, value in settings.items() if value is not None})
+    main.runCohort(args.output)  # Failed patients are printed as they come up
+    print("Wrote {}".format(args.output))
+
+
+def index(args):
+    if args.catalog:
+        from catalog import build_catalog
+
+        patients = build_catalog(args.root, args.index_path)
+        print("{} patients, {} CMJ trials, {} without an injured side".format(
+            len(patients), sum(len(patient["trials"]) for patient in patients),
+            len([patient for patient in patients if patient["injured_side"] is None])))
+        return
+
+    from c3d_index import build_index, query_index
+
+    print(json.dumps(build_index(args.root, args.index_path)))
+    if args.where:
+        print(query_index(args.index_path, args.where).to_string(index=False))
+
+
+def info(args):
+    from read_c3d import read_c3d_info
+
+    for file in args.files:
+        data = read_c3d_info(file)
+        print(json.dumps({"File": file, "Error": data.get("Error"), "Info": data.get("Info")}, indent=2, default=str))
+
+
+def bench(args):
+    import pandas as pd
+    from bench import run_bench
+
+    with pd.option_context("display.width", 120, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+        print(run_bench(args.patients, args.trials, args.quiet, args.extra_points, args.workers, args.dir))
+
+
+def profile(args):
+    import os
+    from main import getInjuredSide
+    from profiling import profile_trial
+
+    injured_side = args.injured_side or getInjuredSide(os.path.dirname(os.path.dirname(args.file)))
+    profile_trial(args.file, injured_side, args.top, args.stats)
+
+
+def replay(args):
+    from main import metric_spec
+    from force_plate import force_spec
+    from online import replay
+
+    def show(event):
+        print("{phase} {start_time:.3f}-{end_time:.3f} s, out after {latency:.2f} ms".format(
+            latency=event["latency_s"] * 1000, **event))
+        for name, value in event["metrics"].items():
+            print("    {}: {:.3f}".format(name, value))
+
+    replay(args.file, force_spec(metric_spec), args.realtime, args.chunk, args.com, on_phase=show)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog="cmj", description="Countermovement jump metrics from c3d files")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    command = commands.add_parser("run", help="Process every patient folder of a root and write the Excel output")
+    command.add_argument("root", nargs="?", help="Folder of patient folders, main.py's root_dir if left out")
+    command.add_argument("-o", "--output", required=True, help="Excel file to write")
+    command.add_argument("-w", "--workers", type=int, help="Worker processes, 1 runs in this process")
+    command.add_argument("--table", choices=["var_outputs", "combined_asymmetries", "absolute_asymmetries"],
+                         help="Table to export when not writing a results folder")
+    command.add_argument("--cache-dir", help="Keep decoded trials in this folder")
+    command.add_argument("--catalog", help="SQLite catalog of the root, refreshed incrementally")
+    command.add_argument("--manifest", help="SQLite manifest, only changed trials are processed again")
+    command.add_argument("--results-dir", help="Stream every table to this folder as patients finish")
+    command.add_argument("--profile", help="Append profiling spans to this JSON lines file")
+    command.add_argument("--prefetch", type=int, help="Trial files read ahead, carrying on into the next patient")
+    command.add_argument("--float32", action="store_true", help="Decode trials as float32")
+    command.add_argument("--force-only", action="store_true",
+                         help="Force plate metrics from the GRF alone, motion capture is not decoded")
+    command.set_defaults(function=run)
+
+    command = commands.add_parser("index", help="Index the c3d headers (or the patient folders) under a root")
+    command.add_argument("root")
+    command.add_argument("index_path", help="SQLite file, only changed files are read again")
+    command.add_argument("--catalog", action="store_true", help="Build the patient/session/trial catalog instead")
+    command.add_argument("--where", help='Print the indexed trials matching e.g. "is_cmj = 1 AND n_plates = 2"')
+    command.set_defaults(function=index)
+
+    command = commands.add_parser("info", help="Print the header and parameter info of c3d files")
+    command.add_argument("files", nargs="+")
+    command.set_defaults(function=info)
+
+    command = commands.add_parser("bench", help="Time every pipeline stage on a synthetic cohort")
+    command.add_argument("--patients", type=int, default=4)
+    command.add_argument("--trials", type=int, default=3, help="CMJ trials per patient")
+    command.add_argument("--quiet", type=float, default=0.8, help="Seconds of quiet standing, sets the trial length")
+    command.add_argument("--extra-points", type=int, default=20, help="Markers on top of the model outputs")
+    command.add_argument("-w", "--workers", type=int, help="Processes for the cohort stage, every core if left out")
+    command.add_argument("--dir", help="Keep the generated cohort in this folder")
+    command.set_defaults(function=bench)
+
+    command = commands.add_parser("profile", help="Profile calcTrial on one trial")
+    command.add_argument("file")
+    command.add_argument("--injured-side", help="Read from the patient's ENF if left out")
+    command.add_argument("--top", type=int, default=25, help="Functions to print")
+    command.add_argument("--stats", help="Keep the raw cProfile stats in this file")
+    command.set_defaults(function=profile)
+
+    command = commands.add_parser("replay", help="Stream a trial through the online phase detector")
+    command.add_argument("file")
+    command.add_argument("--realtime", action="store_true", help="Feed it at the recorded rate, not at full speed")
+    command.add_argument("--chunk", type=int, default=1, help="Mocap frames of force samples fed at a time")
+    command.add_argument("--com", action="store_true", help="Use the c3d's COMVelocity_z instead of integrating")
+    command.set_defaults(function=replay)
+    return parser
+
+
+def cli(argv=None):
+    args = parser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    cli()
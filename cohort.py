@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import profiling
+
+
+def _run_patients(jobs, table=None):
+    # Runs in the worker process on a batch of patients, so trials are read ahead from one patient into the next.
+    # Only the patient row of table comes back if it's given, every table of the patient otherwise
+    from main import calcCohortTables
+
+    return [(tables["patient"][table] if table and tables else tables, error)
+            for tables, error in calcCohortTables(jobs)]
+
+
+def _patient_jobs(root_dir, catalog_path=None):
+    if catalog_path:  # Injured side and trials come from the catalog, so workers don't search the folders again
+        from catalog import build_catalog
+
+        with profiling.span("discovery", catalog=catalog_path):
+            patients = build_catalog(root_dir, catalog_path)
+        return [patient["path"] for patient in patients], \
+            [(patient["path"], patient["injured_side"], patient["trials"], patient["error"]) for patient in patients]
+
+    # Assume each sub folder in root_dir is a patient folder, discover_patient searches it in the worker
+    patient_paths = [os.path.join(root_dir, folder) for folder in os.listdir(root_dir)]
+    patient_paths = [path for path in patient_paths if os.path.isdir(path)]
+    return patient_paths, [(path, None, None, None) for path in patient_paths]
+
+
+def discover_patient(job):
+    # (patient path, injured side, trials, error) of a (patient path[, injured side, trials, error]) job, searching
+    # the folder unless the trials are already known from the catalog. Any failure becomes the patient's error
+    patient_path, injured_side, trials, error = (tuple(job) + (None, None, None))[:4]
+    if error or trials is not None:
+        return patient_path, injured_side, trials or [], error
+    from main import getInjuredSide, getFiles
+
+    try:
+        with profiling.span("discovery", inherit=False, patient=patient_path):  # May run ahead, in another's span
+            return patient_path, getInjuredSide(patient_path), getFiles(patient_path), None
+    except Exception as err:
+        return patient_path, None, [], "{}: {}".format(type(err).__name__, err)
+
+
+def patient_trials(root_dir, catalog_path=None):
+    # (patient path, injured side, trials, error) of every patient folder in root_dir in the order of a full run,
+    # each folder is searched as it comes up
+    return map(discover_patient, _patient_jobs(root_dir, catalog_path)[1])
+
+
+def _outcomes(jobs, executor, workers=None, table=None):
+    from main import calcCohortTables
+
+    if executor is None:  # One read ahead over the whole cohort
+        return ((tables["patient"][table] if table and tables else tables, error)
+                for tables, error in calcCohortTables(jobs))
+    # Runs of neighbouring patients, a few per worker so the load still evens out. map() hands results back in
+    # submission order, so the sheet comes out the same as a serial run
+    size = -(-len(jobs) // ((workers or os.cpu_count() or 1) * 4)) or 1
+    batches = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    return (outcome for batch in executor.map(partial(_run_patients, table=table), batches) for outcome in batch)
+
+
+def _init_worker(settings, profile, profile_path):
+    import main
+
+    main.configure(**settings)
+    if profile:
+        profiling.enable(profile_path)
+
+
+def worker_pool(workers):
+    # None when workers is 1. Workers start with main.py's settings as they are in this process (they can be
+    # changed from the command line) and log their spans to the same file as this process if profiling is on
+    import main
+
+    if workers == 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(main.settings(), profiling.enabled, profiling.output_path))
+
+
+def run_cohort(root_dir, workers=None, catalog_path=None):
+    import pandas as pd
+    from main import output_table
+
+    patient_paths, jobs = _patient_jobs(root_dir, catalog_path)
+    executor = worker_pool(workers)
+    try:
+        all_results, errors = _collect(patient_paths, _outcomes(jobs, executor, workers, output_table))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    # Convert results to a DataFrame and export to Excel or CSV
+    return pd.DataFrame(all_results), errors
+
+
+def stream_cohort(root_dir, sink, workers=None, catalog_path=None):
+    # Like run_cohort, but every table of each patient goes to the sink as soon as it is done instead of being kept
+    patient_paths, jobs = _patient_jobs(root_dir, catalog_path)
+    executor = worker_pool(workers)
+    errors = []
+    try:
+        for patient_path, (tables, error) in zip(patient_paths, _outcomes(jobs, executor, workers)):
+            patient = os.path.basename(patient_path)
+            if error:
+                print("Failed to process {}: {}".format(patient_path, error))
+                errors.append({"Patient": patient, "Error": error})
+                sink.write_error(patient, error)
+            else:
+                sink.write_patient(patient, tables["files"], tables["trials"], tables["patient"])
+    finally:
+        if executor:
+            executor.shutdown()
+    return errors
+
+
+def _collect(patient_paths, outcomes):
+    all_results = []
+    errors = []
+    for patient_path, (patient_data, error) in zip(patient_paths, outcomes):
+        if error:
+            print("Failed to process {}: {}".format(patient_path, error))
+            errors.append({"Patient": os.path.basename(patient_path), "Error": error})
+        elif patient_data:  # Only add if data was returned
+            all_results.append(patient_data)
+    return all_results, errors
@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+# A curve store is a folder with one float32 file of (rows x frame x channels) time normalised curves, one row per
+# trial and phase, and a SQLite table saying which patient, trial, injured side and phase each row is
+data_name = "curves.f32"
+table_name = "curves.db"
+
+
+def open_curves(store_dir, frame=101, channels=None):
+    # Opens (or creates) the store, frame and channels are fixed by whoever creates it
+    os.makedirs(store_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(store_dir, table_name))
+    connection.execute("CREATE TABLE IF NOT EXISTS layout (frame INTEGER, channels TEXT)")
+    connection.execute("CREATE TABLE IF NOT EXISTS curves (row INTEGER PRIMARY KEY, path TEXT, patient TEXT, "
+                       "trial TEXT, injured_side TEXT, phase TEXT)")
+    if connection.execute("SELECT COUNT(*) FROM layout").fetchone()[0] == 0:
+        if channels is None:
+            raise ValueError("New curve store needs its channels")
+        connection.execute("INSERT INTO layout VALUES (?, ?)", (frame, json.dumps(list(channels))))
+        connection.commit()
+    return connection
+
+
+def _layout(connection):
+    frame, channels = connection.execute("SELECT frame, channels FROM layout").fetchone()
+    return frame, json.loads(channels)
+
+
+def load_curves(store_dir):
+    # Read only memmap of every stored row, nothing is read from disk until it is indexed
+    connection = open_curves(store_dir)
+    frame, channels = _layout(connection)
+    rows = connection.execute("SELECT COUNT(*) FROM curves").fetchone()[0]
+    connection.close()
+    if rows == 0:
+        return np.empty((0, frame, len(channels)), dtype=np.float32)
+    return np.memmap(os.path.join(store_dir, data_name), dtype="<f4", mode="r", shape=(rows, frame, len(channels)))
+
+
+def append_curves(store_dir, curves, rows):
+    # Adds (n x frame x channels) curves with their n (path, patient, trial, injured_side, phase) rows. The data
+    # goes in first and the rows are committed after, a run stopped in between leaves the store as it was
+    connection = open_curves(store_dir)
+    frame, channels = _layout(connection)
+    curves = np.asarray(curves, dtype="<f4")
+    if curves.shape[1:] != (frame, len(channels)) or len(curves) != len(rows):
+        raise ValueError("Curves don't match the store layout")
+    start = connection.execute("SELECT COUNT(*) FROM curves").fetchone()[0]
+    with open(os.path.join(store_dir, data_name), "ab") as file:
+        file.truncate(start * frame * len(channels) * 4)  # Drop anything left by an interrupted append
+        file.write(curves.tobytes())
+    connection.executemany("INSERT INTO curves VALUES (?, ?, ?, ?, ?, ?)",
+                           [(start + i,) + tuple(row) for i, row in enumerate(rows)])
+    connection.commit()
+    connection.close()
+
+
+def query_curves(store_dir, where="1", params=()):
+    # e.g. query_curves(store_dir, "phase = ? AND injured_side IS NOT NULL", ("Landing",)), row indexes the memmap
+    import pandas as pd
+
+    connection = open_curves(store_dir)
+    rows = pd.read_sql_query("SELECT * FROM curves WHERE " + where + " ORDER BY row", connection, params=params)
+    connection.close()
+    return rows
+
+
+def build_curves(root_dir, store_dir, frame=101, catalog_path=None):
+    # Time normalises the ED, Con and Landing phase of every CMJ in root_dir that isn't in the store yet. Channels
+    # are main.py's mocap channels followed by its force channels, a channel a trial doesn't have is left NaN
+    from cohort import patient_trials
+    from main import getCOMVelocity, mocap_channels, force_channels, trial_dtype, prefetch_depth
+    from norm2frame import norm2frame_segments
+    from prefetch import prefetch
+    from segmentation import segment_cmj, phase_windows, phase_names
+    from trial import read_trial
+
+    channels = mocap_channels + force_channels
+    connection = open_curves(store_dir, frame, channels)
+    if _layout(connection) != (frame, channels):
+        raise ValueError("Curve store was built with a different frame count or channels")
+    stored = {path for (path,) in connection.execute("SELECT DISTINCT path FROM curves")}
+    connection.close()
+
+    added = 0
+    for patient_path, injured_side, files, error in patient_trials(root_dir, catalog_path):
+        if error:
+            print("Failed to process {}: {}".format(patient_path, error))
+            continue
+        folder = os.path.basename(patient_path)
+        curves = []
+        rows = []
+        for file, data in prefetch([file for file in files if file not in stored], prefetch_depth):
+            try:
+                trial = read_trial(file, points=mocap_channels, analogs=force_channels, dtype=trial_dtype, data=data)
+                phases = segment_cmj(getCOMVelocity(trial), trial.channel("Fz1") + trial.channel("Fz2"), trial.ratio)
+                mocap_windows, force_windows = phase_windows(phases, trial.ratio)
+                trial_curves = np.full((len(phase_names), frame, len(channels)), np.nan, dtype=np.float32)
+                mocap_columns = [channels.index(label) for label in trial.mocap_columns]
+                force_columns = [channels.index(label) for label in trial.grf_columns]
+                # Cubic interpolation fails on phases shorter than 4 samples
+                trial_curves[:, :, mocap_columns] = norm2frame_segments(trial.mocap, mocap_windows[0], frame)
+                trial_curves[:, :, force_columns] = norm2frame_segments(trial.grf, force_windows[0], frame)
+            except Exception as err:
+                print("Failed to process {}: {}: {}".format(file, type(err).__name__, err))
+                continue
+            curves.append(trial_curves)
+            rows += [(file, folder, os.path.basename(file), injured_side, phase) for phase in phase_names]
+        if curves:  # One append per patient keeps the writes large
+            append_curves(store_dir, np.concatenate(curves), rows)
+            added += len(curves)
+    return {"added": added}
+
+
+def _stream_stats(chunks):
+    # NaN skipping mean and SD (ddof=1) over the rows of a stream of (rows x ...) chunks, combined chunk by chunk
+    # so only one chunk is in memory at a time
+    count = mean = m2 = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=float)
+        valid = ~np.isnan(chunk)
+        chunk_count = valid.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            chunk_mean = np.where(valid, chunk, 0).sum(axis=0) / chunk_count
+            chunk_m2 = np.where(valid, (chunk - chunk_mean) ** 2, 0).sum(axis=0)
+        chunk_mean = np.nan_to_num(chunk_mean)
+        if count is None:
+            count, mean, m2 = chunk_count, chunk_mean, chunk_m2
+            continue
+        total = count + chunk_count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = chunk_mean - mean
+            mean = mean + np.where(total > 0, delta * chunk_count / total, 0)
+            m2 = m2 + chunk_m2 + np.where(total > 0, delta ** 2 * count * chunk_count / total, 0)
+        count = total
+    if count is None:
+        return None, None, None
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, mean, np.nan), np.where(count > 1, np.sqrt(m2 / (count - 1)), np.nan), count
+
+
+def _chunks(curves, rows, chunk_size):
+    rows = np.asarray(rows, dtype=np.int64)
+    for start in range(0, len(rows), chunk_size):
+        yield curves[rows[start:start + chunk_size]], rows[start:start + chunk_size]
+
+
+def curve_mean_sd(store_dir, rows=None, chunk_size=1024):
+    # Mean and SD curve (frame x channels) over the given store rows, e.g. query_curves(...)["row"], or all rows
+    curves = load_curves(store_dir)
+    rows = np.arange(len(curves)) if rows is None else rows
+    mean, sd, count = _stream_stats(chunk for chunk, chunk_rows in _chunks(curves, rows, chunk_size))
+    return mean, sd
+
+
+def side_pairs(channels):
+    # (name, right channel, left channel) of every channel that has both sides, FP1 = Right, FP2 = Left
+    pairs = []
+    for channel in channels:
+        if channel.startswith("R") and "L" + channel[1:] in channels:
+            pairs.append((channel[1:], channel, "L" + channel[1:]))
+        elif channel.endswith("1") and channel[:-1] + "2" in channels:
+            pairs.append((channel[:-1], channel, channel[:-1] + "2"))
+    return pairs
+
+
+def injured_vs_uninjured(store_dir, rows=None, chunk_size=1024):
+    # Mean and SD (frame x pairs) of the uninjured minus the injured side of every left/right channel pair, the
+    # same sign as the asymmetries in metrics.ai_angle. Rows without a recognised injured side are left out.
+    # Returns the pair names with the two curves
+    connection = open_curves(store_dir)
+    frame, channels = _layout(connection)
+    sides = dict(connection.execute("SELECT row, injured_side FROM curves"))
+    connection.close()
+    curves = load_curves(store_dir)
+    rows = np.arange(len(curves)) if rows is None else np.asarray(rows)
+    pairs = side_pairs(channels)
+    right = [channels.index(pair[1]) for pair in pairs]
+    left = [channels.index(pair[2]) for pair in pairs]
+
+    def differences():
+        for chunk, chunk_rows in _chunks(curves, rows, chunk_size):
+            side = np.array([(sides[row] or "").lower()[:1] for row in chunk_rows])
+            injured = np.where((side == "r")[:, None, None], chunk[:, :, right], chunk[:, :, left])
+            uninjured = np.where((side == "r")[:, None, None], chunk[:, :, left], chunk[:, :, right])
+            known = np.isin(side, ["r", "l"])
+            yield (uninjured - injured)[known]
+
+    mean, sd, count = _stream_stats(differences())
+    return [pair[0] for pair in pairs], mean, sd
@@ -0,0 +1,49 @@
+import numpy as np
+
+from metrics import g
+from segmentation import segment_cmj, phase_windows
+from segment_stats import reduce_segments
+
+force_signals = ["Fx", "Fy", "Fz"]
+quiet_time = 0.5  # Seconds of quiet standing at the start of every trial the body weight is measured over
+
+
+def force_spec(spec):
+    # Rows of a metric spec that only need the force plates, jump height comes from the GRF's takeoff velocity
+    return [row for row in spec if row[1] in force_signals or row[4] == "jump_height"]
+
+
+def body_weight(grf_total, rate, quiet=quiet_time):
+    # Mean total vertical GRF (N) over the quiet standing at the start of the trial
+    return float(np.mean(grf_total[:max(int(quiet * rate), 1)]))
+
+
+def _integrate(values, dt):
+    # Cumulative trapezoid rule starting from 0 at the first sample
+    out = np.zeros(len(values))
+    np.cumsum((values[1:] + values[:-1]) * (0.5 * dt), out=out[1:])
+    return out
+
+
+def com_kinematics(grf_total, rate, mass=None, quiet=quiet_time):
+    # COM acceleration (m/s²), velocity (m/s) and displacement (m) from the total vertical GRF, starting at rest.
+    # mass is BODYMASS (kg), weight/g where it is missing. The net force is taken from the weight measured in quiet
+    # standing rather than mass * g, so a BODYMASS a little off the plates doesn't make the velocity drift
+    grf_total = np.asarray(grf_total, dtype=float)
+    weight = body_weight(grf_total, rate, quiet)
+    mass = mass if mass else weight / g
+    acceleration = (grf_total - weight) / mass
+    velocity = _integrate(acceleration, 1.0 / rate)
+    displacement = _integrate(velocity, 1.0 / rate)
+    return acceleration, velocity, displacement
+
+
+def measure_force(trial, channels, quiet=quiet_time):
+    # Max, min, mean and impulse of every force channel in every phase, and the takeoff velocity, found from the
+    # GRF alone. Phases are segment_cmj's on the integrated velocity, so every boundary is a force sample
+    grf_total = trial.channel("Fz1") + trial.channel("Fz2")
+    velocity = com_kinematics(grf_total, trial.force_rate, trial.info.get("BODYMASS"), quiet)[1]
+    phases = segment_cmj(velocity, grf_total, 1)
+    force_windows = phase_windows(phases, 1)[1]
+    force_stats = reduce_segments(trial.grf, force_windows[0], dx=1.0 / trial.force_rate)
+    return np.stack([force_stats[trial.grf_columns[channel]] for channel in channels]), velocity[phases["con_end"]]
@@ -1,21 +1,146 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 import os
-from read_c3d import read_c3d
+from trial import read_trial
+from profiling import span, timed
+from prefetch import prefetch, prefetch_groups
+from segmentation import segment_cmj, phase_windows
+from segment_stats import reduce_segments
+from metrics import compile_metrics, evaluate_metrics, metric_rows, table_names
+from force_plate import force_spec, measure_force
 
 # root_dir = "/Users/nick/Documents/University/Research Project/Not being used/patients with missing mocap data /HT"
 root_dir = "/Users/nick/Documents/University/Research Project/HT"
 
+# Model outputs and force channels the analysis uses, only these get decoded from the c3d's
+mocap_channels = ["CentreOfMass_z", "COMVelocity_z",
+                  "LHipAngles_x", "RHipAngles_x", "LKneeAngles_x", "RKneeAngles_x", "LAnkleAngles_x", "RAnkleAngles_x",
+                  "LHipMoment_x", "RHipMoment_x", "LKneeMoment_x", "RKneeMoment_x", "LAnkleMoment_x", "RAnkleMoment_x"]
+force_channels = ["Fz1", "Fz2"]
+
+# Precision trials are held in, np.float32 halves the memory at the cost of a little rounding in the outputs
+trial_dtype = np.float64
+
+# Set to a folder to keep decoded trials between runs, None reads every c3d from scratch
+cache_dir = None
+
+# Number of processes patients are spread over, None uses every core and 1 runs them one after another
+workers = None
+
+# THIS IS WHERE I CHANGE WHAT I WANT TO OUTPUT (var_outputs, combined_asymmetries, absolute_asymmetries)
+output_table = "absolute_asymmetries"
+
+# DESCRIPTIVE VARIABLES, one row per metric: (name, signal, side, phase, reducer, unit, asymmetry formula)
+# FP1 = Right, FP2 = Left. Reducers are max, min, mean or impulse (trapezoid rule) of the signal over the phase.
+# Every Right row with an asymmetry formula is paired with its Left row, "standard" for AI_calc_standard and
+# "angle" for AI_calc_angle
+metric_spec = [
+    ("Jump Height", "COMVelocity_z", None, "Con", "jump_height", "cm", None),
+    ("Impulse", "Fz", "Right", "ED", "impulse", "N·s", "standard"),
+    ("Impulse", "Fz", "Left", "ED", "impulse", "N·s", "standard"),
+    ("Impulse", "Fz", "Right", "Con", "impulse", "N·s", "standard"),
+    ("Impulse", "Fz", "Left", "Con", "impulse", "N·s", "standard"),
+    ("Impulse", "Fz", "Right", "Landing", "impulse", "N·s", "standard"),
+    ("Impulse", "Fz", "Left", "Landing", "impulse", "N·s", "standard"),
+    ("Peak GRFv", "Fz", "Right", "ED", "max", "N", "standard"),
+    ("Peak GRFv", "Fz", "Right", "Con", "max", "N", "standard"),
+    ("Peak GRFv", "Fz", "Right", "Landing", "max", "N", "standard"),
+    ("Peak GRFv", "Fz", "Left", "ED", "max", "N", "standard"),
+    ("Peak GRFv", "Fz", "Left", "Con", "max", "N", "standard"),
+    ("Peak GRFv", "Fz", "Left", "Landing", "max", "N", "standard"),
+    ("Peak Hip Angle", "HipAngles_x", "Left", "ED", "max", "°", "angle"),
+    ("Peak Hip Angle", "HipAngles_x", "Left", "Con", "max", "°", "angle"),
+    ("Peak Hip Angle", "HipAngles_x", "Left", "Landing", "max", "°", "angle"),
+    ("Peak Hip Angle", "HipAngles_x", "Right", "ED", "max", "°", "angle"),
+    ("Peak Hip Angle", "HipAngles_x", "Right", "Con", "max", "°", "angle"),
+    ("Peak Hip Angle", "HipAngles_x", "Right", "Landing", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Left", "ED", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Left", "Con", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Left", "Landing", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Right", "ED", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Right", "Con", "max", "°", "angle"),
+    ("Peak Knee Angle", "KneeAngles_x", "Right", "Landing", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Left", "ED", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Left", "Con", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Left", "Landing", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Right", "ED", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Right", "Con", "max", "°", "angle"),
+    ("Peak Ankle Angle", "AnkleAngles_x", "Right", "Landing", "max", "°", "angle"),
+    ("Peak Hip Moment", "HipMoment_x", "Left", "ED", "max", "Nm", "standard"),
+    ("Peak Hip Moment", "HipMoment_x", "Left", "Con", "max", "Nm", "standard"),
+    ("Peak Hip Moment", "HipMoment_x", "Left", "Landing", "max", "Nm", "standard"),
+    ("Peak Hip Moment", "HipMoment_x", "Right", "ED", "max", "Nm", "standard"),
+    ("Peak Hip Moment", "HipMoment_x", "Right", "Con", "max", "Nm", "standard"),
+    ("Peak Hip Moment", "HipMoment_x", "Right", "Landing", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Left", "ED", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Left", "Con", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Left", "Landing", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Right", "ED", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Right", "Con", "max", "Nm", "standard"),
+    ("Peak Knee Moment", "KneeMoment_x", "Right", "Landing", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Left", "ED", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Left", "Con", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Left", "Landing", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Right", "ED", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Right", "Con", "max", "Nm", "standard"),
+    ("Peak Ankle Moment", "AnkleMoment_x", "Right", "Landing", "max", "Nm", "standard")
+]
+
+# Set to a folder to write every table (trials and patients) as each patient finishes, CSV or Parquet if pyarrow
+# is installed, with the Excel file made from it at the end. None keeps everything in memory and writes output_table
+results_dir = None
+
+# Set to a manifest file to only recompute new or changed trials, None recomputes everything
+manifest_path = None
+
+# Number of trials read ahead on background threads while the current one is computed, 0 reads each when needed
+prefetch_depth = 2
+
+# Set to a catalog file to find patients, sessions and trials from a stored scan of root_dir that only re-lists
+# changed folders, None searches every patient folder on each run
+catalog_path = None
+
+# Set to a .jsonl file to log the wall time, data read and peak memory of every stage, trial and patient
+profile_path = None
+
+# Set to True for force plate screening, only the GRF is decoded and the phases come from the COM velocity integrated
+# from it, so trials without motion capture work too. Only the metric_spec rows of force channels and jump height are
+# output. The manifest records the mode of every trial, switching it recomputes them
+force_only = False
+
+# Set to one c3d to run it under cProfile and tracemalloc instead of running the cohort
+profile_file = None
+
+# Bump whenever a metric definition changes, so the incremental run recomputes every trial
+metrics_version = 2
+
+# Compiled once, evaluating it costs the same for every trial however many rows metric_spec has
+metric_plan = compile_metrics(metric_spec)
+force_plan = compile_metrics(force_spec(metric_spec))
+
+# Settings above the command line can change, worker processes get the same values as the process that starts them
+setting_names = ["root_dir", "mocap_channels", "force_channels", "trial_dtype", "cache_dir", "workers", "output_table",
+                 "results_dir", "manifest_path", "prefetch_depth", "catalog_path", "profile_path", "force_only"]
+
+
+def configure(**settings):
+    for name, value in settings.items():
+        if name not in setting_names:
+            raise ValueError("Unknown setting: {}".format(name))
+        globals()[name] = value
+
+
+def settings():
+    return {name: globals()[name] for name in setting_names}
+
 
 # Setting the directory to run through
 # patient_dir = "/Users/nick/Documents/University/Research Project/HT/AB 127331 Retest"
 
 
-def calcPatient(patient_dir):
-    # print(os.listdir(patient_dir)) # to see which file is being processed currently
-
+def getInjuredSide(patient_dir):
     # Checking ENF file for injured side
+    injured_side = None
     enf_file_path = None
     for filename in os.listdir(patient_dir):
         if filename.endswith(".enf"):
@@ -32,321 +157,160 @@ def calcPatient(patient_dir):
     else:
         print("No ENF file found in the directory.")
 
-    # Get CMJ c3d files
-    def getFiles():
-        files = []
-        # Walk through directory, check for any folder with "New Session" in its name
-        for (dirpath, dirnames, filenames) in os.walk(patient_dir):
-            for d in dirnames:
-                if "New Session" in d:  # This checks if the substring is in the directory name
-                    new_session_path = os.path.join(str(dirpath), str(d))
-                    for session_file in os.listdir(new_session_path):
-                        session_file = str(session_file)  # Ensure session_file is a string
-                        if session_file.endswith(".c3d") and "CMJ" in session_file and "SL" not in session_file:
-                            file_path = os.path.join(new_session_path, session_file)
-                            files.append(file_path)
-
-        return files
-
-    cmjs = getFiles()  # All the cmj c3d's in the directory provided
-
-    trial_results = []  # List to store results for all trials for this patient
-    trial_number = 1
-
-    # FOR EACH CMJ
-    for file in cmjs:
-        patient_name = os.path.basename(os.path.dirname(os.path.dirname(file)))
-
-        data = read_c3d(file, read_mocap=True)  # Read the c3d data...
-
-        mocap = data["MoCap"]  # And separate it into the motion capture data..
-        grf = data["GRF"]  # The GRF data
-        info = data["Info"]  # And general info
-
-        mocapDF = pd.DataFrame(mocap)  # Create dataFrames
-        grfDF = pd.DataFrame(grf)
-        infoDF = pd.DataFrame(info)
-
-        grfTotal = grfDF["Fz1"] + grfDF["Fz2"]  # Sum of the two forces to get total vertical GRF
-        sampling_rate = 1000
-
-        com_vel_z = None
-
-        if "COMVelocity_z" not in mocapDF.columns:  # Some data is missing Com velocity, this is to check
-            # print("Column 'COMVelocity_z' not found. Available columns:", mocapDF.columns.tolist())
-            dt = 1.0 / sampling_rate # Calculate time step
-            # Use central difference method to calculate COM velocity Z based off COMz position
-            mocapDF["COMVelocity_z"] = np.gradient(mocapDF["CentreOfMass_z"], dt)
-            com_vel_z = mocapDF["COMVelocity_z"] / sampling_rate
-
-        else:
-            com_vel_z = mocapDF["COMVelocity_z"] / sampling_rate
-
-        max_velocity = com_vel_z.idxmax()
-        vel_before_max_velocity = com_vel_z[:max_velocity]
-
-        # Eccentric Deceleration Phase (Max neg-vel to zero)
-        ED_start = vel_before_max_velocity.idxmin()  # Lowest vel before flight phase
-        ED_end = vel_before_max_velocity[ED_start:].ge(0).idxmax()  # Find first 0 value after ED_start
-
-        # Concentric Phase (zero vel to takeoff)
-        con_start = ED_end  # Zero vel
-        con_end = max_velocity  # takeoff
-
-        # Landing Phase (Landing to Zero vel)
-        top_of_flight_vel = com_vel_z[con_end:].ge(0).idxmin()  # mid-point of flight where vel = 0
-        landing_start = grfTotal[top_of_flight_vel:].idxmin()
-        landing_end = com_vel_z[landing_start:].ge(0).idxmax()
-
-        # -------------------------
-        # Plotting
-        # -------------------------
-
-        # Define colors for clarity
-
-        # velocity_graph_color = "black"
-        # phase_color = "black"
-        # end_time = len(grfTotal) / sampling_rate
-        #
-        # fig, ax1 = plt.subplots(figsize=(10, 6))
-        #
-        # # FP1 = Right, FP2 = Left
-        #
-        # ax1.plot(grfDF["Fz1"], "red", label="Right")
-        # ax1.plot(grfDF["Fz2"], "blue", label="Left")
-        # ax1.set_xlabel("Time (s)")
-        # ax1.set_ylabel("Force (N)")
-        #
-        # # Plot COM Velocity on right axis
-        # ax2 = ax1.twinx()
-        # ax2.plot(com_vel_z, velocity_graph_color, linestyle="--", label="Velocity (m/s)")
-        # ax2.set_ylabel("Velocity (m/s)", color=velocity_graph_color)
-        # ax2.tick_params(axis="y", labelcolor=velocity_graph_color)
-        # ax2.set_ylim(-3, 8)
-        #
-        # # Spans
-        # ax2.axvspan(ED_start, ED_end, color="red", alpha=0.1, label="Eccentric Deceleration")  # Eccentric Deceleration
-        # ax2.axvspan(ED_end, con_end, color="blue", alpha=0.1, label="Concentric")  # Concentric
-        # ax2.axvspan(landing_start, landing_end, color="green", alpha=0.1, label="Landing")  # Concentric
-        #
-        # # Set the title (using the file name for reference)
-        # ax1.set_title(f"CMJ Phases: {os.path.basename(file)}")
-        #
-        # # Combine legends from both axes
-        # handles1, labels1 = ax1.get_legend_handles_labels()
-        # handles2, labels2 = ax2.get_legend_handles_labels()
-        # ax1.legend(handles1 + handles2, labels1 + labels2, loc="upper right")
-        #
-        # plt.tight_layout()
-        # plt.show()
-
-        # -------------------------
-        # Variable calculations
-        # -------------------------
-
-        # Jump height sing the impulse-momentum equation
-        g = 9.81  # Gravity
-        v_takeoff = com_vel_z.loc[con_end]  # Extract velocity at takeoff
-        jump_height_cm = (v_takeoff ** 2) / (2 * g) * 100
-
-        # Impulse using trapezoid rule
-        dt = 1.0 / sampling_rate  # Time step based on  sampling rate
-        impulse_ED_Right = np.trapz(grfDF["Fz1"][ED_start:ED_end], dx=dt)
-        impulse_ED_Left = np.trapz(grfDF["Fz2"][ED_start:ED_end], dx=dt)
-        impulse_con_Right = np.trapz(grfDF["Fz1"][con_start:con_end], dx=dt)
-        impulse_con_Left = np.trapz(grfDF["Fz2"][con_start:con_end], dx=dt)
-        impulse_landing_Right = np.trapz(grfDF["Fz1"][landing_start:landing_end], dx=dt)
-        impulse_landing_Left = np.trapz(grfDF["Fz2"][landing_start:landing_end], dx=dt)
-
-        # Peak GRFv
-        peak_GRFv_ED_Right = grf["Fz1"][ED_start:ED_end].max()
-        peak_GRFv_con_Right = grf["Fz1"][con_start:con_end].max()
-        peak_GRFv_landing_Right = grf["Fz1"][landing_start:landing_end].max()
-        peak_GRFv_ED_Left = grf["Fz2"][ED_start:ED_end].max()
-        peak_GRFv_con_Left = grf["Fz2"][con_start:con_end].max()
-        peak_GRFv_landing_Left = grf["Fz2"][landing_start:landing_end].max()
-
-        # Peak Hip Flexion Angles
-        peak_hip_angle_ED_Left = mocapDF["LHipAngles_x"][ED_start:ED_end].max()
-        peak_hip_angle_con_Left = mocapDF["LHipAngles_x"][con_start:con_end].max()
-        peak_hip_angle_landing_Left = mocapDF["LHipAngles_x"][landing_start:landing_end].max()
-        peak_hip_angle_ED_Right = mocapDF["RHipAngles_x"][ED_start:ED_end].max()
-        peak_hip_angle_con_Right = mocapDF["RHipAngles_x"][con_start:con_end].max()
-        peak_hip_angle_landing_Right = mocapDF["RHipAngles_x"][landing_start:landing_end].max()
-
-        # Peak Knee Flexion Angles
-        peak_knee_angle_ED_Left = mocapDF["LKneeAngles_x"][ED_start:ED_end].max()
-        peak_knee_angle_con_Left = mocapDF["LKneeAngles_x"][con_start:con_end].max()
-        peak_knee_angle_landing_Left = mocapDF["LKneeAngles_x"][landing_start:landing_end].max()
-        peak_knee_angle_ED_Right = mocapDF["RKneeAngles_x"][ED_start:ED_end].max()
-        peak_knee_angle_con_Right = mocapDF["RKneeAngles_x"][con_start:con_end].max()
-        peak_knee_angle_landing_Right = mocapDF["RKneeAngles_x"][landing_start:landing_end].max()
-
-        # Peak Ankle Flexion Angles
-        peak_ankle_angle_ED_Left = mocapDF["LAnkleAngles_x"][ED_start:ED_end].max()
-        peak_ankle_angle_con_Left = mocapDF["LAnkleAngles_x"][con_start:con_end].max()
-        peak_ankle_angle_landing_Left = mocapDF["LAnkleAngles_x"][landing_start:landing_end].max()
-        peak_ankle_angle_ED_Right = mocapDF["RAnkleAngles_x"][ED_start:ED_end].max()
-        peak_ankle_angle_con_Right = mocapDF["RAnkleAngles_x"][con_start:con_end].max()
-        peak_ankle_angle_landing_Right = mocapDF["RAnkleAngles_x"][landing_start:landing_end].max()
-
-        # Peak Hip Extension Moment
-        peak_hip_moment_ED_Left = mocapDF["LHipMoment_x"][ED_start:ED_end].max()
-        peak_hip_moment_con_Left = mocapDF["LHipMoment_x"][con_start:con_end].max()
-        peak_hip_moment_landing_Left = mocapDF["LHipMoment_x"][landing_start:landing_end].max()
-        peak_hip_moment_ED_Right = mocapDF["RHipMoment_x"][ED_start:ED_end].max()
-        peak_hip_moment_con_Right = mocapDF["RHipMoment_x"][con_start:con_end].max()
-        peak_hip_moment_landing_Right = mocapDF["RHipMoment_x"][landing_start:landing_end].max()
-
-        # Peak Knee Extension Moment
-        peak_knee_moment_ED_Left = mocapDF["LKneeMoment_x"][ED_start:ED_end].max()
-        peak_knee_moment_con_Left = mocapDF["LKneeMoment_x"][con_start:con_end].max()
-        peak_knee_moment_landing_Left = mocapDF["LKneeMoment_x"][landing_start:landing_end].max()
-        peak_knee_moment_ED_Right = mocapDF["RKneeMoment_x"][ED_start:ED_end].max()
-        peak_knee_moment_con_Right = mocapDF["RKneeMoment_x"][con_start:con_end].max()
-        peak_knee_moment_landing_Right = mocapDF["RKneeMoment_x"][ED_start:ED_end].max()
-
-        # Peak Knee Extension Moment
-        peak_ankle_moment_ED_Left = mocapDF["LAnkleMoment_x"][ED_start:ED_end].max()
-        peak_ankle_moment_con_Left = mocapDF["LAnkleMoment_x"][con_start:con_end].max()
-        peak_ankle_moment_landing_Left = mocapDF["LAnkleMoment_x"][landing_start:landing_end].max()
-        peak_ankle_moment_ED_Right = mocapDF["RAnkleMoment_x"][ED_start:ED_end].max()
-        peak_ankle_moment_con_Right = mocapDF["RAnkleMoment_x"][con_start:con_end].max()
-        peak_ankle_moment_landing_Right = mocapDF["RAnkleMoment_x"][landing_start:landing_end].max()
-
-        # DESCRIPTIVE VARIABLES INTO A DICTIONARY
-        var_outputs = {
-            # "Patient": patient_name, # ONLY ADD WHEN GENERATING DESCRIPTIVES!!!
-            # "Trial Number": trial_number,
-            "Jump Height (cm)": jump_height_cm,
-            "Impulse ED Right (N·s)": impulse_ED_Right,
-            "Impulse ED Left (N·s)": impulse_ED_Left,
-            "Impulse Con Right (N·s)": impulse_con_Right,
-            "Impulse Con Left (N·s)": impulse_con_Left,
-            "Impulse Landing Right (N·s)": impulse_landing_Right,
-            "Impulse Landing Left (N·s)": impulse_landing_Left,
-            "Peak GRFv ED Right (N)": peak_GRFv_ED_Right,
-            "Peak GRFv Con Right (N)": peak_GRFv_con_Right,
-            "Peak GRFv Landing Right (N)": peak_GRFv_landing_Right,
-            "Peak GRFv ED Left (N)": peak_GRFv_ED_Left,
-            "Peak GRFv Con Left (N)": peak_GRFv_con_Left,
-            "Peak GRFv Landing Left (N)": peak_GRFv_landing_Left,
-            "Peak Hip Angle ED Left (°)": peak_hip_angle_ED_Left,
-            "Peak Hip Angle Con Left (°)": peak_hip_angle_con_Left,
-            "Peak Hip Angle Landing Left (°)": peak_hip_angle_landing_Left,
-            "Peak Hip Angle ED Right (°)": peak_hip_angle_ED_Right,
-            "Peak Hip Angle Con Right (°)": peak_hip_angle_con_Right,
-            "Peak Hip Angle Landing Right (°)": peak_hip_angle_landing_Right,
-            "Peak Knee Angle ED Left (°)": peak_knee_angle_ED_Left,
-            "Peak Knee Angle Con Left (°)": peak_knee_angle_con_Left,
-            "Peak Knee Angle Landing Left (°)": peak_knee_angle_landing_Left,
-            "Peak Knee Angle ED Right (°)": peak_knee_angle_ED_Right,
-            "Peak Knee Angle Con Right (°)": peak_knee_angle_con_Right,
-            "Peak Knee Angle Landing Right (°)": peak_knee_angle_landing_Right,
-            "Peak Ankle Angle ED Left (°)": peak_ankle_angle_ED_Left,
-            "Peak Ankle Angle Con Left (°)": peak_ankle_angle_con_Left,
-            "Peak Ankle Angle Landing Left (°)": peak_ankle_angle_landing_Left,
-            "Peak Ankle Angle ED Right (°)": peak_ankle_angle_ED_Right,
-            "Peak Ankle Angle Con Right (°)": peak_ankle_angle_con_Right,
-            "Peak Ankle Angle Landing Right (°)": peak_ankle_angle_landing_Right,
-            "Peak Hip Moment ED Left (Nm)": peak_hip_moment_ED_Left,
-            "Peak Hip Moment Con Left (Nm)": peak_hip_moment_con_Left,
-            "Peak Hip Moment Landing Left (Nm)": peak_hip_moment_landing_Left,
-            "Peak Hip Moment ED Right (Nm)": peak_hip_moment_ED_Right,
-            "Peak Hip Moment Con Right (Nm)": peak_hip_moment_con_Right,
-            "Peak Hip Moment Landing Right (Nm)": peak_hip_moment_landing_Right,
-            "Peak Knee Moment ED Left (Nm)": peak_knee_moment_ED_Left,
-            "Peak Knee Moment Con Left (Nm)": peak_knee_moment_con_Left,
-            "Peak Knee Moment Landing Left (Nm)": peak_knee_moment_landing_Left,
-            "Peak Knee Moment ED Right (Nm)": peak_knee_moment_ED_Right,
-            "Peak Knee Moment Con Right (Nm)": peak_knee_moment_con_Right,
-            "Peak Knee Moment Landing Right (Nm)": peak_knee_moment_landing_Right,
-            "Peak Ankle Moment ED Left (Nm)": peak_ankle_moment_ED_Left,
-            "Peak Ankle Moment Con Left (Nm)": peak_ankle_moment_con_Left,
-            "Peak Ankle Moment Landing Left (Nm)": peak_ankle_moment_landing_Left,
-            "Peak Ankle Moment ED Right (Nm)": peak_ankle_moment_ED_Right,
-            "Peak Ankle Moment Con Right (Nm)": peak_ankle_moment_con_Right,
-            "Peak Ankle Moment Landing Right (Nm)": peak_ankle_moment_landing_Right
-        }
-
-        # -------------------------
-        # Asymmetry calculations
-        # AI = ((Uninjured vs ACLR limb) / (whichever is biggest)) * 100
-        # Positive number means uninjured performed BETTER than injured
-        # -------------------------
-
-        # Separate joint angles from the rest as they need different AI calculation
-        angle_vars = {}
-        non_angle_vars = {}
-
-        for key, value in var_outputs.items():  # Checking if it's an angle variable
-            if "Angle" in key:
-                angle_vars[key] = value
-            else:
-                non_angle_vars[key] = value
-
-        # Calculate asymmetry
-        def AI_calc_standard(right, left, inj_side):
-            asymIndex = None
-
-            if inj_side.lower().startswith("r"):  # Input can vary e.g "Right" or "R"
-                asymIndex = ((left - right) / max(right, left)) * 100
-            elif inj_side.lower().startswith("l"):
-                asymIndex = ((right - left) / max(right, left)) * 100
-            else:
-                raise ValueError("Injured side not recognised: ", patient_dir)
-            return asymIndex
-
-        def AI_calc_angle(right, left, inj_side):
-            if inj_side.lower().startswith("r"):
-                return left - right
-            elif inj_side.lower().startswith("l"):
-                return right - left
-            else:
-                raise ValueError("Injured side not recognised.")
-
-        # Calculating asymmetries separately for non-angles
-        var_asym_non_angles = {}
-        for key in non_angle_vars:
-            if "Right" in key:
-                right_key = key
-                left_key = key.replace("Right", "Left")
-                # Create base key by removing "right" and units
-                base_key = right_key.split("Right")[0].strip().split(" (")[0].strip()
-                right_value = non_angle_vars[right_key]
-                left_value = non_angle_vars[left_key]
-                ai_value = AI_calc_standard(right_value, left_value, injured_side)
-                var_asym_non_angles[base_key] = ai_value
-
-        # Calculate asymmetries separately for joint angle variables using a different function
-        var_asym_angles = {}
-        for key in angle_vars:
-            if "Right" in key:
-                right_key = key
-                left_key = key.replace("Right", "Left")
-                base_key = right_key.split("Right")[0].strip().split(" (")[0].strip()
-                right_value = angle_vars[right_key]
-                left_value = angle_vars[left_key]
-                ai_value = AI_calc_angle(right_value, left_value, injured_side)
-                var_asym_angles[base_key] = ai_value
-
-        # Joining the two dictionaries together, so I can output them all at the same time
-        combined_asymmetries = {}
-        combined_asymmetries.update(var_asym_non_angles)
-        combined_asymmetries.update(var_asym_angles)
-
-        # Absolute Asymmetry Indices
-        absolute_asymmetries = combined_asymmetries.copy()
-        # Iterate and update each value with its AAI = should just be the same value but with direction taken away.
-        for key, value in absolute_asymmetries.items():
-            # Square root of the squared AI
-            absolute_asymmetries[key] = abs(value)
-
-        trial_results.append(absolute_asymmetries)  # THIS IS WHERE I CHANGE WHAT I WANT TO OUTPUT (var_outputs,
-        # combined asymmetries, absolute asymmetries)
-        trial_number += 1
-
-        # Average the trial results if there are multiple trials
+    return injured_side
+
+
+# Get CMJ c3d files
+def getFiles(patient_dir):
+    files = []
+    # Walk through directory, check for any folder with "New Session" in its name
+    for (dirpath, dirnames, filenames) in os.walk(patient_dir):
+        for d in dirnames:
+            if "New Session" in d:  # This checks if the substring is in the directory name
+                new_session_path = os.path.join(str(dirpath), str(d))
+                for session_file in os.listdir(new_session_path):
+                    session_file = str(session_file)  # Ensure session_file is a string
+                    if session_file.endswith(".c3d") and "CMJ" in session_file and "SL" not in session_file:
+                        file_path = os.path.join(new_session_path, session_file)
+                        files.append(file_path)
+
+    return files
+
+
+def getCOMVelocity(trial):
+    sampling_rate = 1000
+
+    if "COMVelocity_z" not in trial:  # Some data is missing Com velocity, this is to check
+        dt = 1.0 / sampling_rate # Calculate time step
+        # Use central difference method to calculate COM velocity Z based off COMz position
+        return np.gradient(trial.channel("CentreOfMass_z"), dt) / sampling_rate
+
+    return trial.channel("COMVelocity_z") / sampling_rate
+
+
+# Max, min, mean and impulse of every metric_plan channel in every phase, and the takeoff velocity of one trial
+@timed("trial", "trial")
+def measureTrial(file, data=None):
+    # Read the c3d data into contiguous sample x channel arrays, DataFrames are only built if asked for
+    with span("decode") as record:
+        trial = read_trial(file, points=mocap_channels, analogs=force_channels, dtype=trial_dtype,
+                           cache_dir=cache_dir, data=data)
+        record["bytes"] = os.path.getsize(file)
+        record["frames"] = len(trial.mocap)
+
+    grfTotal = trial.channel("Fz1") + trial.channel("Fz2")  # Sum of the two forces to get total vertical GRF
+    sampling_rate = 1000
+
+    com_vel_z = getCOMVelocity(trial)
+
+    # Phase boundaries as sample positions, force samples per mocap frame lines the two rates up
+    ratio = trial.ratio
+    with span("segmentation"):
+        phases = segment_cmj(com_vel_z, grfTotal, ratio)
+
+    # -------------------------
+    # Plotting
+    # -------------------------
+
+    # Define colors for clarity
+
+    # import matplotlib.pyplot as plt
+    #
+    # # Eccentric Deceleration Phase (Max neg-vel to zero)
+    # ED_start = trial.mocap_time(phases["ED_start"])  # Lowest vel before flight phase
+    # ED_end = trial.mocap_time(phases["ED_end"])  # First 0 value after ED_start
+    #
+    # # Concentric Phase (zero vel to takeoff)
+    # con_end = trial.mocap_time(phases["con_end"])  # takeoff
+    #
+    # # Landing Phase (Landing to Zero vel)
+    # landing_start = trial.force_time(phases["landing_start_force"])  # Lowest GRF after the top of flight
+    # landing_end = trial.mocap_time(phases["landing_end"])
+    #
+    # velocity_graph_color = "black"
+    # phase_color = "black"
+    # end_time = len(grfTotal) / sampling_rate
+    #
+    # fig, ax1 = plt.subplots(figsize=(10, 6))
+    #
+    # # FP1 = Right, FP2 = Left
+    #
+    # grfDF = trial.grf_frame()
+    # ax1.plot(grfDF["Fz1"], "red", label="Right")
+    # ax1.plot(grfDF["Fz2"], "blue", label="Left")
+    # ax1.set_xlabel("Time (s)")
+    # ax1.set_ylabel("Force (N)")
+    #
+    # # Plot COM Velocity on right axis
+    # ax2 = ax1.twinx()
+    # ax2.plot(com_vel_z, velocity_graph_color, linestyle="--", label="Velocity (m/s)")
+    # ax2.set_ylabel("Velocity (m/s)", color=velocity_graph_color)
+    # ax2.tick_params(axis="y", labelcolor=velocity_graph_color)
+    # ax2.set_ylim(-3, 8)
+    #
+    # # Spans
+    # ax2.axvspan(ED_start, ED_end, color="red", alpha=0.1, label="Eccentric Deceleration")  # Eccentric Deceleration
+    # ax2.axvspan(ED_end, con_end, color="blue", alpha=0.1, label="Concentric")  # Concentric
+    # ax2.axvspan(landing_start, landing_end, color="green", alpha=0.1, label="Landing")  # Concentric
+    #
+    # # Set the title (using the file name for reference)
+    # ax1.set_title(f"CMJ Phases: {os.path.basename(file)}")
+    #
+    # # Combine legends from both axes
+    # handles1, labels1 = ax1.get_legend_handles_labels()
+    # handles2, labels2 = ax2.get_legend_handles_labels()
+    # ax1.legend(handles1 + handles2, labels1 + labels2, loc="upper right")
+    #
+    # plt.tight_layout()
+    # plt.show()
+
+    # -------------------------
+    # Variable calculations
+    # -------------------------
+
+    # Jump height sing the impulse-momentum equation, from the velocity at takeoff
+    v_takeoff = com_vel_z[phases["con_end"]]  # Extract velocity at takeoff
+
+    # Max, min, mean and impulse of every channel in every phase, in one pass over each data block
+    dt = 1.0 / sampling_rate  # Time step based on  sampling rate
+    mocap_windows, force_windows = phase_windows(phases, ratio)
+    with span("metrics"):
+        mocap_stats = reduce_segments(trial.mocap, mocap_windows[0])
+        force_stats = reduce_segments(trial.grf, force_windows[0], dx=dt)  # Impulse using trapezoid rule
+
+    # In metric_plan's channel order, a channel the trial doesn't have fails the trial like before
+    stats = [mocap_stats[trial.mocap_columns[channel]] if channel in trial.mocap_columns
+             else force_stats[trial.grf_columns[channel]] for channel in metric_plan["channels"]]
+    return np.stack(stats), v_takeoff
+
+
+# Same as measureTrial for force_plan's channels, without decoding any motion capture data
+@timed("trial", "trial")
+def measureForceTrial(file, data=None):
+    with span("decode") as record:
+        trial = read_trial(file, points=[], analogs=force_channels, dtype=trial_dtype, cache_dir=cache_dir, data=data)
+        record["bytes"] = os.path.getsize(file)
+        record["frames"] = len(trial.grf)
+
+    with span("metrics"):
+        return measure_force(trial, force_plan["channels"])
+
+
+def trialMeasure():
+    # The metric plan and the function measuring one trial for it, depending on force_only
+    return (force_plan, measureForceTrial) if force_only else (metric_plan, measureTrial)
+
+
+def calcTrial(file, injured_side, data=None):
+    # Every output table of one trial, calcPatient picks the one set in output_table
+    plan, measure = trialMeasure()
+    stats, v_takeoff = measure(file, data)
+    tables = evaluate_metrics(plan, stats[None], [v_takeoff], [injured_side])
+    return metric_rows(plan, tables)
+
+
+def averageTrials(trial_results, patient_dir):
+    # Average the trial results if there are multiple trials
     if trial_results:
         # Create a DataFrame from the list of trial dictionaries and average them across trials
         avg_df = pd.DataFrame(trial_results).mean(axis=0)
@@ -358,27 +322,105 @@ def calcPatient(patient_dir):
         return None
 
 
-# Now, iterate through each patient folder in the root directory
-all_results = []
+@timed("patient", "patient")
+def calcPatientTables(patient_dir, injured_side=None, cmjs=None, trials=None):
+    # print(os.listdir(patient_dir)) # to see which file is being processed currently
+    # trials are the (file, raw bytes) of cmjs when they are already being read ahead, see calcCohortTables
+
+    if cmjs is None:  # Not already looked up in the catalog or by calcCohortTables
+        with span("discovery"):
+            injured_side = getInjuredSide(patient_dir)
+            cmjs = getFiles(patient_dir)  # All the cmj c3d's in the directory provided
+
+    plan, measure = trialMeasure()
+    trial_stats = []  # Stats and takeoff velocity of every trial for this patient
+
+    # FOR EACH CMJ, the next files are already being read while this one is computed
+    for file, data in trials if trials is not None else prefetch(cmjs, 0 if cache_dir else prefetch_depth):
+        trial_stats.append(measure(file, data))
+
+    # All the patient's trials go through the metric plan at once
+    trial_results = []
+    if trial_stats:
+        stats, v_takeoff = zip(*trial_stats)
+        tables = evaluate_metrics(plan, np.stack(stats), v_takeoff, [injured_side] * len(stats))
+        trial_results = [metric_rows(plan, tables, trial) for trial in range(len(stats))]
+
+    # Every table of every trial, and the patient averages of each table
+    return {"files": cmjs, "trials": trial_results,
+            "patient": {table: averageTrials([trial[table] for trial in trial_results], patient_dir)
+                        for table in table_names}}
+
+
+def calcPatient(patient_dir, injured_side=None, cmjs=None):
+    return calcPatientTables(patient_dir, injured_side, cmjs)["patient"][output_table]
+
+
+def calcCohortTables(jobs):
+    # calcPatientTables of every (patient_dir[, injured_side, cmjs, error]) job in turn, yielding (tables, error). A
+    # job with an error (e.g. from the catalog) is only handed back. The trial files are read ahead across patients,
+    # so the next patient's first trial loads while this one's last is computed
+    from cohort import discover_patient
+
+    def patients():
+        for patient_dir, injured_side, cmjs, error in map(discover_patient, jobs):
+            yield (patient_dir, injured_side, error), cmjs
+
+    for (patient_dir, injured_side, error), cmjs, trials in prefetch_groups(
+            patients(), 0 if cache_dir else prefetch_depth):
+        if error:
+            yield None, error
+            continue
+        try:
+            yield calcPatientTables(patient_dir, injured_side, cmjs, trials), None
+        except Exception as err:  # Any failure is handed back instead of killing the run
+            yield None, "{}: {}".format(type(err).__name__, err)
+
+
+def runCohort(excel_output_path):
+    import profiling
+    from cohort import run_cohort, stream_cohort
+    from manifest import run_incremental
+
+    if profile_path:
+        profiling.enable(profile_path, reset=True)
+
+    # Now, run every patient folder in the root directory, spread over the worker processes
+    if results_dir and not manifest_path:  # Rows are on disk as soon as each patient is done
+        from results import ResultsSink
+
+        sink = ResultsSink(results_dir)
+        errors = stream_cohort(root_dir, sink, workers, catalog_path)
+        with span("export"):
+            sink.to_excel(excel_output_path)
+    else:
+        errors = []
+        if manifest_path:
+            df = run_incremental(root_dir, manifest_path, workers, output_table, catalog_path)
+        else:
+            df, errors = run_cohort(root_dir, workers, catalog_path)
+
+        with span("export"):
+            df.to_excel(excel_output_path, index=False)
 
-# Assume each sub folder in root_dir is a patient folder
-for folder in os.listdir(root_dir):
-    patient_path = os.path.join(root_dir, folder)
-    if os.path.isdir(patient_path):
-        patient_data = calcPatient(patient_path)
-        if patient_data:  # Only add if data was returned
-            all_results.append(patient_data)
+    if profile_path:
+        print(profiling.summary(profile_path))
 
-# Convert results to a DataFrame and export to Excel or CSV
-df = pd.DataFrame(all_results)
+    # Alternatively:
+    # df.to_csv("AllPatients.csv", index=False)
+    return errors
 
 
-# UNCOMMENT LINES BELOW TO EXPORT TO EXCEL
-excel_output_path = "/Users/nick/Documents/University/Research Project/DATA OUTPUT SPREADSHEETS/Missing data patients included/HT/HT_Absolute_Asymmetries.xlsx"
-df.to_excel(excel_output_path, index=False)
+if __name__ == "__main__":
+    # UNCOMMENT LINES BELOW TO EXPORT TO EXCEL
+    excel_output_path = "/Users/nick/Documents/University/Research Project/DATA OUTPUT SPREADSHEETS/Missing data patients included/HT/HT_Absolute_Asymmetries.xlsx"
 
-# Alternatively:
-# df.to_csv("AllPatients.csv", index=False)
+    if profile_file:  # Profile a single trial instead
+        from profiling import profile_trial
+
+        profile_trial(profile_file, getInjuredSide(os.path.dirname(os.path.dirname(profile_file))))
+    else:
+        runCohort(excel_output_path)
 
-# To use if I just want to look at one person
-# calcPatient("/Users/nick/Documents/University/Research Project/HT/CMcN 162530 Retest")
+    # To use if I just want to look at one person
+    # calcPatient("/Users/nick/Documents/University/Research Project/HT/CMcN 162530 Retest")
@@ -0,0 +1,109 @@
+import json
+import os
+import sqlite3
+
+
+def open_manifest(manifest_path):
+    connection = sqlite3.connect(manifest_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS trials ("
+        "path TEXT PRIMARY KEY, patient TEXT, patient_position INTEGER, position INTEGER, size INTEGER, mtime REAL, "
+        "metrics_version INTEGER, injured_side TEXT, results TEXT, error TEXT, mode TEXT)"
+    )
+    # Manifests from before the force-only mode have no mode, their rows are recomputed once
+    if "mode" not in [column[1] for column in connection.execute("PRAGMA table_info(trials)")]:
+        connection.execute("ALTER TABLE trials ADD COLUMN mode TEXT")
+    return connection
+
+
+def _run_trial(job):
+    # Runs in the worker process, returns the per-trial tables or the error message
+    from main import calcTrial
+
+    file, injured_side = job
+    try:
+        return json.dumps(calcTrial(file, injured_side), default=float), None
+    except Exception as err:
+        return None, "{}: {}".format(type(err).__name__, err)
+
+
+def update_manifest(root_dir, manifest_path, workers=1, catalog_path=None):
+    # Recompute only the trials that are new, changed on disk, computed by an older metrics_version or in the other
+    # mode (full or force_only) or whose patient's injured side changed, and forget trials that no longer exist
+    from main import metrics_version, force_only
+    from cohort import patient_trials, worker_pool
+
+    mode = "force_only" if force_only else "full"
+    connection = open_manifest(manifest_path)
+    known = {row[0]: row[1:] for row in connection.execute(
+        "SELECT path, size, mtime, metrics_version, injured_side, mode FROM trials WHERE error IS NULL")}
+    seen = set()
+    jobs = []
+    rows = []
+
+    # Rows keep the order of a full run
+    for patient_position, (patient_path, injured_side, files, error) in enumerate(
+            patient_trials(root_dir, catalog_path)):
+        folder = os.path.basename(patient_path)
+        if error:  # Skipped this time, its rows are kept rather than dropped as removed
+            print("Failed to process {}: {}".format(patient_path, error))
+            seen.update(path for (path,) in connection.execute("SELECT path FROM trials WHERE patient = ?", (folder,)))
+            continue
+        for position, file in enumerate(files):
+            stat = os.stat(file)
+            seen.add(file)
+            row = [file, folder, patient_position, position, stat.st_size, stat.st_mtime, metrics_version,
+                   injured_side, mode]
+            if known.get(file) == tuple(row[4:]):
+                connection.execute("UPDATE trials SET patient_position = ?, position = ? WHERE path = ?",
+                                   (patient_position, position, file))
+                continue
+            jobs.append((file, injured_side))
+            rows.append(row)
+
+    executor = worker_pool(workers)
+    outcomes = executor.map(_run_trial, jobs) if executor else map(_run_trial, jobs)
+
+    for row, (results, error) in zip(rows, outcomes):
+        if error:
+            print("Failed to process {}: {}".format(row[0], error))
+        connection.execute("INSERT OR REPLACE INTO trials (path, patient, patient_position, position, size, mtime, "
+                           "metrics_version, injured_side, mode, results, error) VALUES "
+                           "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row + [results, error])
+        connection.commit()  # Every finished trial is kept even if the run is stopped part way
+
+    if executor:
+        executor.shutdown()
+
+    # Drop trials that have been removed from the root since the last run
+    removed = [path for (path,) in connection.execute("SELECT path FROM trials") if path not in seen]
+    connection.executemany("DELETE FROM trials WHERE path = ?", [(path,) for path in removed])
+    connection.commit()
+    connection.close()
+    return {"trials": len(seen), "computed": len(jobs), "removed": len(removed)}
+
+
+def manifest_results(manifest_path, output_table="absolute_asymmetries"):
+    # Patient averages re-aggregated from the stored per-trial rows, in the same layout as run_cohort
+    import pandas as pd
+    from main import averageTrials
+
+    connection = open_manifest(manifest_path)
+    rows = connection.execute(
+        "SELECT patient, results FROM trials WHERE error IS NULL ORDER BY patient_position, position").fetchall()
+    connection.close()
+
+    trials = {}
+    for patient, results in rows:
+        trials.setdefault(patient, []).append(json.loads(results)[output_table])
+    all_results = []
+    for patient in trials:
+        patient_data = averageTrials(trials[patient], patient)
+        if patient_data:  # Only add if data was returned
+            all_results.append(patient_data)
+    return pd.DataFrame(all_results)
+
+
+def run_incremental(root_dir, manifest_path, workers=1, output_table="absolute_asymmetries", catalog_path=None):
+    update_manifest(root_dir, manifest_path, workers, catalog_path)
+    return manifest_results(manifest_path, output_table)
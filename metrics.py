@@ -0,0 +1,108 @@
+import numpy as np
+
+from segmentation import phase_names
+from segment_stats import stat_names
+
+g = 9.81  # Gravity
+asymmetry_formulas = ["standard", "angle"]  # Also the order the asymmetry columns come out in
+table_names = ["var_outputs", "combined_asymmetries", "absolute_asymmetries"]
+
+
+def _channel(signal, side):
+    # Column a signal is read from, force plate channels are numbered by plate (FP1 = Right, FP2 = Left) and model
+    # outputs carry the side as an L/R prefix
+    if side is None:
+        return signal
+    if signal in ["Fx", "Fy", "Fz"]:
+        return signal + ("1" if side == "Right" else "2")
+    return side[0] + signal
+
+
+def metric_name(name, side, phase, unit):
+    # e.g. "Peak Hip Angle ED Left (°)", or "Jump Height (cm)" for a metric without sides
+    if side is None:
+        return "{} ({})".format(name, unit)
+    return "{} {} {} ({})".format(name, phase, side, unit)
+
+
+def compile_metrics(spec):
+    # Turns the (name, signal, side, phase, reducer, unit, asymmetry) rows into index arrays, so evaluating every
+    # metric and asymmetry of a batch of trials is a handful of array operations however many rows there are.
+    # Reducers are the segment_stats stats of the signal over the phase, or jump_height from the takeoff velocity
+    channels = []
+    for name, signal, side, phase, reducer, unit, asymmetry in spec:
+        if reducer != "jump_height" and _channel(signal, side) not in channels:
+            channels.append(_channel(signal, side))
+
+    names, flat, jump = [], [], []
+    for name, signal, side, phase, reducer, unit, asymmetry in spec:
+        names.append(metric_name(name, side, phase, unit))
+        if reducer == "jump_height":
+            flat.append(0)
+            jump.append(True)
+        else:
+            flat.append(np.ravel_multi_index((channels.index(_channel(signal, side)), phase_names.index(phase),
+                                              stat_names.index(reducer)), (len(channels), len(phase_names),
+                                                                           len(stat_names))))
+            jump.append(False)
+
+    # Pair every Right metric with its Left one, standard asymmetries first and then the angle ones
+    pairs = []
+    for formula in asymmetry_formulas:
+        for right, (name, signal, side, phase, reducer, unit, asymmetry) in enumerate(spec):
+            if side != "Right" or asymmetry != formula:
+                continue
+            left = [i for i, row in enumerate(spec) if row[0] == name and row[3] == phase and row[2] == "Left"]
+            if not left:
+                raise ValueError("No Left metric for " + names[right])
+            pairs.append(("{} {}".format(name, phase), right, left[0], formula == "angle"))
+
+    return {"names": names, "channels": channels, "flat": np.array(flat, dtype=np.int64),
+            "jump": np.array(jump, dtype=bool), "asymmetry_names": [pair[0] for pair in pairs],
+            "right": np.array([pair[1] for pair in pairs], dtype=np.int64),
+            "left": np.array([pair[2] for pair in pairs], dtype=np.int64),
+            "angle": np.array([pair[3] for pair in pairs], dtype=bool)}
+
+
+def injured_right(injured_sides):
+    # True where the right side is injured, the side can be written e.g "Right" or "R"
+    codes = []
+    for side in injured_sides:
+        code = str(side).lower()[:1]
+        if code not in ["r", "l"]:
+            raise ValueError("Injured side not recognised: {}".format(side))
+        codes.append(code == "r")
+    return np.array(codes, dtype=bool)
+
+
+def ai_standard(right, left, is_right):
+    # AI_calc_standard: difference of the uninjured and injured side as a percentage of the larger one
+    return np.where(is_right, left - right, right - left) / np.maximum(right, left) * 100
+
+
+def ai_angle(right, left, is_right):
+    # AI_calc_angle: plain difference of the uninjured and injured side
+    return np.where(is_right, left - right, right - left)
+
+
+def evaluate_metrics(plan, stats, takeoff_velocity, injured_sides):
+    # stats is (trials x plan channels x phases x stats) from reduce_segments, takeoff_velocity (trials) in m/s.
+    # Returns the var_outputs, combined_asymmetries and absolute_asymmetries tables as (trials x columns) arrays
+    stats = np.asarray(stats, dtype=float).reshape(len(stats), -1)
+    takeoff_velocity = np.asarray(takeoff_velocity, dtype=float)
+    values = stats[:, plan["flat"]]
+    values[:, plan["jump"]] = ((takeoff_velocity ** 2) / (2 * g) * 100)[:, None]  # Impulse-momentum equation
+
+    right = values[:, plan["right"]]
+    left = values[:, plan["left"]]
+    is_right = injured_right(injured_sides)[:, None]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        combined = np.where(plan["angle"], ai_angle(right, left, is_right), ai_standard(right, left, is_right))
+    return dict(zip(table_names, [values, combined, np.abs(combined)]))
+
+
+def metric_rows(plan, tables, trial=0):
+    # One trial of evaluate_metrics as the {column: value} dictionaries calcTrial hands back
+    return {"var_outputs": dict(zip(plan["names"], tables["var_outputs"][trial].tolist())),
+            "combined_asymmetries": dict(zip(plan["asymmetry_names"], tables["combined_asymmetries"][trial].tolist())),
+            "absolute_asymmetries": dict(zip(plan["asymmetry_names"], tables["absolute_asymmetries"][trial].tolist()))}
@@ -1,7 +1,54 @@
+from functools import lru_cache
+
+import numpy as np
+
+
 def norm2frame(data, frame):
-    import numpy as np
     from scipy.interpolate import interp1d
     x = np.array (range (0, len (data)))
     new_x = np.linspace (x.min (), x.max (), frame)
     new_y = interp1d (x, data, kind='cubic') (new_x)
-    return new_y
\ No newline at end of file
+    return new_y
+
+
+# this function builds the (frame x length) matrix that does norm2frame's cubic interpolation, the spline is linear
+# in the data so interpolating the identity gives the weights of every input sample. Kept for the next call of the
+# same size, read only as it is shared
+@lru_cache(maxsize=128)
+def cubic_operator(length, frame):
+    from scipy.interpolate import interp1d
+    x = np.arange(length)
+    new_x = np.linspace(x.min(), x.max(), frame)
+    operator = interp1d(x, np.eye(length), kind='cubic', axis=0)(new_x)
+    operator.flags.writeable = False
+    return operator
+
+
+# this function time normalises many signals at once. data is (samples), (samples x channels),
+# (trials x samples x channels) or a list of arrays of different lengths, which come back stacked as
+# (trials x frame x channels). Signals of the same length share one matrix product
+def norm2frame_batch(data, frame):
+    if isinstance(data, (list, tuple)):
+        segments = [np.asarray(segment, dtype=float) for segment in data]
+        if not segments:
+            return np.empty((0, frame))
+        out = np.empty((len(segments), frame) + segments[0].shape[1:])
+        lengths = np.array([len(segment) for segment in segments])
+        for length in np.unique(lengths):
+            same = np.flatnonzero(lengths == length)
+            # Samples are the second axis of the stack, channels (if any) after it
+            out[same] = np.einsum("fl,kl...->kf...", cubic_operator(int(length), frame),
+                                  np.stack([segments[i] for i in same]))
+        return out
+
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 3:
+        return cubic_operator(data.shape[1], frame) @ data
+    return cubic_operator(data.shape[0], frame) @ data
+
+
+# this function time normalises the inclusive (start, end) sample windows of a (samples x channels) array, e.g. the
+# phase windows from segmentation.phase_windows, to (windows x frame x channels)
+def norm2frame_segments(data, windows, frame):
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    return norm2frame_batch([data[start:end + 1] for start, end in windows], frame)
@@ -0,0 +1,272 @@
+import time
+
+import numpy as np
+
+from force_plate import quiet_time
+from metrics import g, compile_metrics
+from segmentation import phase_names
+from segment_stats import stat_names
+
+# Thresholds of the online detector
+onset_sd = 5  # Movement starts once the GRF drops this many SDs of the quiet standing GRF below body weight
+onset_force = 10.0  # N, smallest drop that counts as movement, for very steady quiet standing
+flight_force = 20.0  # N, total vertical GRF below which the athlete is in the air
+state_names = ["Quiet", "Unweighting", "Con", "Flight", "Landing", "Done"]  # Unweighting runs on to the end of ED
+
+
+class _PhaseStats:
+    # Running max, min, mean and trapezoid impulse of every channel from the first sample of a phase, like
+    # reduce_segments over the same inclusive window
+    __slots__ = ("start", "end", "count", "maxima", "minima", "sums", "impulses", "last")
+
+    def __init__(self, start, values):
+        self.start = self.end = start
+        self.count = 1
+        self.maxima = list(values)
+        self.minima = list(values)
+        self.sums = list(values)
+        self.impulses = [0.0] * len(values)
+        self.last = list(values)
+
+    def add(self, sample, values, dt):
+        for i, value in enumerate(values):
+            if value > self.maxima[i]:
+                self.maxima[i] = value
+            if value < self.minima[i]:
+                self.minima[i] = value
+            self.sums[i] += value
+            self.impulses[i] += 0.5 * (self.last[i] + value) * dt
+        self.last = list(values)
+        self.end = sample
+        self.count += 1
+
+    def copy(self):
+        other = _PhaseStats.__new__(_PhaseStats)
+        other.start, other.end, other.count = self.start, self.end, self.count
+        other.maxima, other.minima, other.sums = list(self.maxima), list(self.minima), list(self.sums)
+        other.impulses, other.last = list(self.impulses), list(self.last)
+        return other
+
+    def stats(self, channels):
+        # {channel: {stat: value}} in stat_names order
+        return {channel: dict(zip(stat_names, (self.maxima[i], self.minima[i], self.sums[i] / self.count,
+                                               self.impulses[i])))
+                for i, channel in enumerate(channels)}
+
+
+class OnlineCMJ:
+    # Incremental CMJ phase detector for a live force plate stream. push() takes one sample of the force channels
+    # (and optionally the COM velocity in m/s) and returns the phases it closed, usually none, with the same work
+    # for every sample. Body weight and velocity are worked out like force_plate.com_kinematics (the velocity is the
+    # c3d's COM velocity instead if it is given) and the phases follow segment_cmj's rules: ED from the lowest
+    # velocity to zero velocity, Con up to the highest velocity and Landing from the lowest GRF after the top of the
+    # flight to zero velocity, so a trial gets the same metrics as the force_only pipeline. The Unweighting and ED
+    # events both come out once the velocity is back to zero, the end of ED is the first time the lowest velocity
+    # is known.
+    # spec is a metric spec like main.metric_spec, its rows on these channels come out with the phase they're in
+    def __init__(self, channels=("Fz1", "Fz2"), rate=1000.0, mass=None, spec=None, quiet=quiet_time, on_phase=None):
+        self.channels = list(channels)
+        self.vertical = [i for i, channel in enumerate(self.channels) if channel.startswith("Fz")]
+        self.rate = rate
+        self.dt = 1.0 / rate
+        self.body_mass = mass
+        self.quiet_samples = max(int(quiet * rate), 1)
+        self.on_phase = on_phase
+        self.sample = -1  # Index of the last sample pushed, counts on across reset()
+
+        # Which spec rows each phase closes, as (name, channel, stat)
+        self.phase_metrics = {phase: [] for phase in phase_names}
+        self.jump_names = []
+        if spec:
+            plan = compile_metrics([row[:6] + (None,) for row in spec])  # Asymmetries need both sides at the end
+            channel, phase, stat = np.unravel_index(plan["flat"], (max(len(plan["channels"]), 1), len(phase_names),
+                                                                   len(stat_names)))
+            for k, name in enumerate(plan["names"]):
+                if plan["jump"][k]:
+                    self.jump_names.append(name)
+                elif plan["channels"][channel[k]] in self.channels:  # Rows on other channels can't be measured
+                    self.phase_metrics[phase_names[phase[k]]].append(
+                        (name, plan["channels"][channel[k]], stat_names[stat[k]]))
+        self.reset()
+
+    def reset(self):
+        # Arms the detector for the next jump, the body weight is measured again from the next samples
+        self.state = "Quiet"
+        self.weight = None
+        self.threshold = None
+        self.mass = self.body_mass
+        self.quiet_sum = 0.0
+        self.quiet_squares = 0.0
+        self.samples = 0  # Samples since reset()
+        self.force_integral = 0.0
+        self.last_total = None
+        self.velocity = 0.0
+        self.phase = None  # Stats of the phase in progress
+        self.unweighting = None  # Unweighting stats up to the lowest velocity so far
+        self.ed = None  # ED stats from the lowest velocity so far
+        self.lowest_velocity = np.inf
+        self.braking = False  # Net force has turned upwards since the start of the unweighting
+        self.peak = None  # Con stats up to the highest velocity so far
+        self.peak_velocity = -np.inf
+        self.takeoff = None
+        self.landing = None  # Landing stats from the lowest GRF since the top of the flight
+        self.lowest = np.inf
+
+    def _close(self, stats, state, extra=None):
+        # Event of a finished phase, with its stats and the spec metrics it completes
+        channel_stats = stats.stats(self.channels)
+        event = {"phase": state, "start": stats.start, "end": stats.end, "detected": self.sample,
+                 "start_time": stats.start / self.rate, "end_time": stats.end / self.rate, "stats": channel_stats,
+                 "metrics": {name: channel_stats[channel][stat]
+                             for name, channel, stat in self.phase_metrics.get(state, [])}}
+        event["metrics"].update(extra or {})
+        if self.on_phase:
+            self.on_phase(event)
+        return event
+
+    def push(self, values, com_velocity=None):
+        self.sample += 1
+        sample = self.sample
+        total = 0.0
+        for i in self.vertical:
+            total += values[i]
+        closed = []
+
+        # Trapezoid integral of the total GRF since the first sample of the jump. Once the body weight is known it
+        # gives the velocity force_plate.com_kinematics integrates from rest at the first sample, in O(1)
+        if self.samples:
+            self.force_integral += (self.last_total + total) * (0.5 * self.dt)
+        self.last_total = total
+        self.samples += 1
+
+        if self.weight is None:
+            # Body weight and its noise from the same first samples force_plate.body_weight uses
+            self.quiet_sum += total
+            self.quiet_squares += total * total
+            if self.phase is None:
+                self.phase = _PhaseStats(sample, values)
+            else:
+                self.phase.add(sample, values, self.dt)
+            if self.samples == self.quiet_samples:
+                self.weight = self.quiet_sum / self.samples
+                variance = max(self.quiet_squares / self.samples - self.weight ** 2, 0.0)
+                self.threshold = max(onset_sd * variance ** 0.5, onset_force)
+                self.mass = self.body_mass or self.weight / g
+            return closed
+
+        if com_velocity is None:
+            self.velocity = (self.force_integral - self.weight * (self.samples - 1) * self.dt) / self.mass
+        else:
+            self.velocity = com_velocity
+        velocity = self.velocity
+
+        state = self.state
+        if state == "Done":
+            return closed
+        self.phase.add(sample, values, self.dt)
+
+        if state == "Quiet":
+            if total < self.weight - self.threshold:
+                closed.append(self._close(self.phase, "Quiet", {"Body Weight (N)": self.weight}))
+                self.phase = _PhaseStats(sample, values)
+                self.unweighting = self.phase.copy()
+                self.ed = _PhaseStats(sample, values)
+                self.lowest_velocity = velocity
+                self.braking = False
+                self.state = "Unweighting"
+        elif state == "Unweighting":
+            # ED starts at the lowest velocity, which is only certain once the velocity is back to zero. Until then
+            # the Unweighting stats up to the lowest velocity so far and the ED stats from it are both kept
+            if velocity < self.lowest_velocity:
+                self.lowest_velocity = velocity
+                self.unweighting = self.phase.copy()
+                self.ed = _PhaseStats(sample, values)
+            else:
+                self.ed.add(sample, values, self.dt)
+            if total >= self.weight:  # Net force upwards, the real dip is under way and not noise around rest
+                self.braking = True
+            if self.braking and velocity >= 0:
+                closed.append(self._close(self.unweighting, "Unweighting",
+                                          {"Lowest Velocity (m/s)": self.lowest_velocity}))
+                closed.append(self._close(self.ed, "ED"))
+                self.phase = _PhaseStats(sample, values)
+                self.peak = self.phase.copy()
+                self.peak_velocity = velocity
+                self.state = "Con"
+        elif state == "Con":
+            if velocity > self.peak_velocity:
+                self.peak_velocity = velocity
+                self.peak = self.phase.copy()
+            if total < flight_force:  # Takeoff, Con ends at the highest velocity before it
+                jump_height = self.peak_velocity ** 2 / (2 * g) * 100  # Impulse-momentum equation
+                extra = {name: jump_height for name in self.jump_names}
+                extra["Takeoff Velocity (m/s)"] = self.peak_velocity
+                closed.append(self._close(self.peak, "Con", extra))
+                self.phase = _PhaseStats(sample, values)
+                self.takeoff = sample
+                self.landing = None
+                self.lowest = np.inf
+                self.state = "Flight"
+        elif state == "Flight":
+            # Landing starts at the lowest GRF after the top of the flight, restart it whenever a lower one comes
+            if velocity < 0 and total < self.lowest:
+                self.lowest = total
+                self.landing = _PhaseStats(sample, values)
+            elif self.landing is not None:
+                self.landing.add(sample, values, self.dt)
+            if total >= flight_force:
+                flight_time = (sample - self.takeoff) / self.rate
+                closed.append(self._close(self.phase, "Flight", {
+                    "Flight Time (s)": flight_time, "Jump Height Flight Time (cm)": g * flight_time ** 2 / 8 * 100}))
+                if self.landing is None:  # Never saw the top of the flight, e.g. with a COM velocity that lags
+                    self.landing = _PhaseStats(sample, values)
+                self.phase = self.landing  # Already holds this sample
+                self.state = "Landing"
+        elif state == "Landing" and velocity >= 0:
+            closed.append(self._close(self.phase, "Landing"))
+            self.state = "Done"
+        return closed
+
+    def push_block(self, forces, com_velocity=None):
+        # A (samples x channels) block, com_velocity (samples) in m/s if given
+        closed = []
+        forces = np.asarray(forces, dtype=float).tolist()
+        if com_velocity is None:
+            for values in forces:
+                closed += self.push(values)
+        else:
+            for values, velocity in zip(forces, np.asarray(com_velocity, dtype=float).tolist()):
+                closed += self.push(values, velocity)
+        return closed
+
+
+def replay(file, spec=None, realtime=False, chunk_frames=1, com=False, channels=("Fz1", "Fz2"), on_phase=None):
+    # Streams a c3d through an OnlineCMJ chunk_frames mocap frames at a time, as fast as possible or at the speed
+    # it was recorded. Every event gets "latency_s", the wall time from the chunk that closed the phase arriving to
+    # the event coming out. com feeds the c3d's COMVelocity_z as well
+    from read_c3d import read_c3d_info, iter_c3d_chunks
+
+    info = read_c3d_info(file)
+    if "Error" in info:
+        raise ValueError("{}: {}".format(file, info["Error"]))
+    info = info["Info"]
+    detector = OnlineCMJ(channels, info["FP_RATE"], info["BODYMASS"], spec)
+    ratio = int(info["FP_RATE"] / info["CAMERA_RATE"])
+    events = []
+    started = time.perf_counter()
+    for chunk in iter_c3d_chunks(file, chunk_frames, points=["COMVelocity_z"] if com else [], analogs=channels):
+        forces = chunk["GRF"][:, [chunk["GRFLabels"].index(channel) for channel in channels]]
+        velocity = None
+        if com:
+            velocity = np.repeat(chunk["MoCap"][:, chunk["MoCapLabels"].index("COMVelocity_z")] / 1000, ratio)
+        if realtime:  # The chunk arrives once its last sample has been recorded
+            arrived = started + (detector.sample + 1 + len(forces)) / detector.rate
+            time.sleep(max(arrived - time.perf_counter(), 0))
+        else:
+            arrived = time.perf_counter()
+        for event in detector.push_block(forces, velocity):
+            event["latency_s"] = time.perf_counter() - arrived
+            if on_phase:
+                on_phase(event)
+            events.append(event)
+    return events
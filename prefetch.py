@@ -0,0 +1,79 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+def _read_bytes(file):
+    # None when the file can't be read, the c3d reader then opens it itself and reports the error as usual
+    try:
+        with open(file, "rb") as handle:
+            return handle.read()
+    except OSError:
+        return None
+
+
+def prefetch(files, depth=2, threads=None):
+    # Yields (file, raw bytes) in order while the next `depth` files are read on background threads, so storage
+    # latency overlaps with the computing of the current trial. Reads only run `depth` files ahead of the consumer,
+    # which bounds the memory held and holds the readers back when the computing is the slow part
+    files = iter(files)
+    if depth < 1:
+        for file in files:
+            yield file, None
+        return
+
+    with ThreadPoolExecutor(max_workers=threads or depth) as executor:
+        pending = deque((file, executor.submit(_read_bytes, file)) for file in islice(files, depth))
+        while pending:
+            file, future = pending.popleft()
+            for next_file in islice(files, 1):  # Keep the queue topped up before handing this one over
+                pending.append((next_file, executor.submit(_read_bytes, next_file)))
+            yield file, future.result()
+
+
+def prefetch_groups(groups, depth=2, threads=None):
+    # prefetch over the files of every group one after another, so reading ahead runs on into the next group, e.g.
+    # the next patient's first trial loads while this patient's last one is computed. groups yields (group, files)
+    # and is only advanced as far as reading ahead needs. Yields (group, files, trials), trials yields the group's
+    # (file, raw bytes) and what a group leaves unused is skipped when the next one is asked for
+    groups = iter(groups)
+    if depth < 1:
+        for group, files in groups:
+            yield group, files, ((file, None) for file in files)
+        return
+
+    listed = deque()  # Groups whose files are being read ahead and that haven't been handed out yet
+    pending = deque()  # (group number, file, future) of the files read ahead
+
+    def flat():
+        for number, (group, files) in enumerate(groups):
+            listed.append((number, group, files))
+            for file in files:
+                yield number, file
+
+    files_ahead = flat()
+
+    def top_up():
+        for number, file in islice(files_ahead, depth - len(pending)):
+            pending.append((number, file, executor.submit(_read_bytes, file)))
+
+    def trials(number, files):
+        for _ in files:
+            top_up()
+            _, file, future = pending.popleft()  # Earlier groups are used up, so this is the group's next file
+            top_up()
+            yield file, future.result()
+
+    with ThreadPoolExecutor(max_workers=threads or depth) as executor:
+        while True:
+            top_up()
+            if not listed:  # Nothing read ahead, list on to the next group even if it has no files
+                for number, file in islice(files_ahead, 1):
+                    pending.append((number, file, executor.submit(_read_bytes, file)))
+                if not listed:
+                    return
+            number, group, files = listed.popleft()
+            group_trials = trials(number, files)
+            yield group, files, group_trials
+            for _ in group_trials:  # Skip what the consumer left, e.g. after a trial failed
+                pass
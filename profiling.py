@@ -0,0 +1,134 @@
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+# Spans only record anything once enable() is called, until then they cost a clock read and nothing else
+enabled = False
+output_path = None  # JSON lines file every record is appended to, shared by worker processes
+_records = []
+_context = []  # Fields of the enclosing spans, so a decode span knows its patient and trial
+
+
+def enable(path=None, reset=False):
+    # Start recording spans, also appending them to path as JSON lines when it is set. reset empties the file,
+    # worker processes call this with reset=False so they add to the file the parent started
+    global enabled, output_path
+    enabled = True
+    output_path = path
+    if path and reset:
+        open(path, "w").close()
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def peak_rss():
+    # High-water resident memory of this process and its finished children in bytes, None where unsupported
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak if sys.platform == "darwin" else peak * 1024  # macOS reports bytes, Linux kilobytes
+
+
+@contextmanager
+def span(stage, inherit=True, **fields):
+    # Times the block as one record. The record is yielded so the block can add what it did, e.g.
+    # record["bytes"] or record["frames"]. inherit=False leaves out the fields of the enclosing spans, for work done
+    # ahead for something else, e.g. the next patient's discovery while this one is running
+    if not enabled:
+        yield {}
+        return
+
+    record = {}
+    for outer in _context if inherit else []:
+        record.update(outer)
+    record.update(fields)
+    _context.append(fields)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        _context.pop()
+        peak = peak_rss()
+        record.update({"stage": stage, "seconds": time.perf_counter() - start, "pid": os.getpid(),
+                       "peak_rss_mb": peak / 2 ** 20 if peak is not None else None})
+        _records.append(record)
+        if output_path:
+            with open(output_path, "a") as file:  # One short write per line, so processes don't interleave
+                file.write(json.dumps(record, default=str) + "\n")
+
+
+def timed(stage, field=None):
+    # Decorator version of span, field names the record entry the first argument is stored under
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            fields = {field: args[0]} if field and args else {}
+            with span(stage, **fields):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def records(path=None):
+    # Records of this process, or every record in a JSON lines file
+    if path is None:
+        return list(_records)
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summary(path=None):
+    # One row per stage: how often it ran, its total/mean/max wall time, data it went through and peak memory
+    import pandas as pd
+
+    df = pd.DataFrame(records(path))
+    if df.empty:
+        return df
+    for column in ["bytes", "frames"]:
+        if column not in df:
+            df[column] = float("nan")
+    stages = df.groupby("stage", sort=False)
+    table = stages.agg(count=("seconds", "size"), total_s=("seconds", "sum"), mean_s=("seconds", "mean"),
+                       max_s=("seconds", "max"), peak_rss_mb=("peak_rss_mb", "max"))
+    table["bytes"] = stages["bytes"].sum(min_count=1)
+    table["frames"] = stages["frames"].sum(min_count=1)
+    return table.sort_values("total_s", ascending=False)
+
+
+def profile_trial(file, injured_side="Right", top=25, stats_path=None):
+    # Runs calcTrial on one file under cProfile and tracemalloc, prints the hottest functions and the lines that
+    # allocated the most, and returns the trial results. stats_path keeps the raw profile for snakeviz etc.
+    import cProfile
+    import pstats
+    import tracemalloc
+    from main import calcTrial
+
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    profiler.enable()
+    try:
+        results = calcTrial(file, injured_side)
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    stats = pstats.Stats(profiler)
+    if stats_path:
+        stats.dump_stats(stats_path)
+    stats.sort_stats("cumulative").print_stats(top)
+
+    print("Traced memory peak {:.1f} MB, {:.1f} MB still held".format(peak / 2 ** 20, current / 2 ** 20))
+    for stat in snapshot.statistics("lineno")[:10]:
+        print(stat)
+    return results
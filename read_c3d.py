@@ -1,8 +1,12 @@
+import io
+import os
+
+import c3d
+import numpy as np
+
+
 # this function reads c3d files
-def read_c3d(file, read_mocap=True):
-    import os
-    import c3d
-    import numpy as np
+def read_c3d(file, read_mocap=True, bulk=True, points=None, analogs=None):
     import pandas as pd
     # check if file exists
     if not os.path.exists(file):
@@ -14,105 +18,30 @@ def read_c3d(file, read_mocap=True):
             reader = c3d.Reader(file_id)
         except:
             raise ValueError('Reading Error of file')
-        # get other info
-        info = dict()
-        col_of_int = ['DATEOFCAPTURE', 'USER', 'VERSION', 'DESCRIPTION', 'NOTE']
-        ssc_info = reader.get('SSCDATAANDPROCESSING')
-        if ssc_info is None:
-            # if no processing was done at all
-            for field in col_of_int:
-                info[field] = [None]
-        else:
-            for field in col_of_int:
-                val = ssc_info.get(field)
-                if val is None:
-                    info[field] = [None]
-                elif val.dimensions[0] == 0:
-                    info[field] = [None]
-                else:
-                    try:
-                        info[field] = val.string_array
-                    except UnicodeDecodeError:
-                        if val.bytes_array[0] == b'Zhan\xe9':
-                            info[field] = 'Zhane'
-                        else:
-                            info[field] = val.string_array
-        col_of_int = ['BODYMASS', 'HEIGHT']
-        ssc_info = reader.get('PROCESSING')
-        if ssc_info is None:
-            # if no processing was done at all
-            for field in col_of_int:
-                info[field] = None
-        else:
-            for field in col_of_int:
-                val = ssc_info.get(field)
-                if val is None:
-                    info[field] = None
-                elif val.dimensions[0] == 0:
-                    info[field] = None
-                else:
-                    info[field] = val.float_value
-        col_of_int = ['Names']
-        ssc_info = reader.get('SUBJECTS')
-        if ssc_info is None:
-            # if no processing was done at all
-            for field in col_of_int:
-                info[field] = None
-        else:
-            for field in col_of_int:
-                val = ssc_info.get(field)
-                if val is None:
-                    info[field] = [None]
-                else:
-                    info[field] = val.float_value
-        # reader.get('TRIAL.CAMERA_RATE').float_value
-        col_of_int = ['CAMERA_RATE']
-        ssc_info = reader.get('TRIAL')
-        for field in col_of_int:
-            val = ssc_info.get(field)
-            if val is None:
-                info[field] = None
-            else:
-                info[field] = val.float_value
-        info['FP_RATE'] = reader.get('ANALOG').get('RATE').float_value
-        # get borders of plate 1 and plate 2 to compute mid point of fp to infer
-        #   direction. Negative would imply to the right, while positive would imply to
-        #   the left
-        # get labels
-        mocap_labels = reader.point_labels
-        mocap_labels = [x.replace(' ', '') for x in mocap_labels]
-        mocap_labels = sum([[x + '_x', x + '_y', x + '_z'] for x in mocap_labels], [])
-        force_labels = reader.get('ANALOG')
-        force_labels = force_labels.get('LABELS')
-        force_labels = force_labels.string_array
-        force_labels = [x.replace(' ', '') for x in force_labels]
-        force_labels = [x.replace('Force.', '') for x in force_labels]
-        force_labels = [x.replace('Moment.', '') for x in force_labels]
-        if len(force_labels) == 0:
-            file_id.close()
-            raise ValueError('No ForcePlate Data in C3D please check file')
-        fp_border = reader.get('FORCE_PLATFORM')
-        fp_border = fp_border.get('CORNERS')
-        fp_border = fp_border.float_array
-        n_planes, n_points, n_plates = fp_border.shape
-        fp_border = np.array(fp_border).reshape(n_plates, n_points, n_planes)
-        for count in range(0, n_plates):
-            info['xmidposFP' + str(count + 1)] = float(fp_border[count].mean(axis=0)[0])
+        info = _read_info(reader)
+        mocap_labels, point_columns, force_labels, analog_columns, n_force_labels = \
+            _select_labels(reader, points, analogs)
         frequency_ratio = int(info['FP_RATE'] / info['CAMERA_RATE'])
         if read_mocap:
             frames = reader.header.last_frame - reader.header.first_frame + 1
-            mocap_data = np.empty(shape=(frames, len(mocap_labels)))
-            force_frames = int(frames * (info['FP_RATE'] / info['CAMERA_RATE']))
-            force_data = np.empty(shape=(force_frames, len(force_labels)))
-            force_frame, current_frame = [int(x) for x in np.linspace(0, force_frames, num=frames + 1)], 0
-            # read in data frame by frame
-            for frame, points, analog in reader.read_frames(copy=False):
-                if frame < reader.header.first_frame or frame > reader.header.last_frame:
-                    continue
-                mocap_data[current_frame, :] = np.array(points[:, 0:3]).reshape(1, len(mocap_labels))
-                force_data[force_frame[current_frame]:force_frame[current_frame + 1], :] = \
-                    np.array(analog).reshape(frequency_ratio, len(force_labels))
-                current_frame += 1
+            if bulk:
+                # decode the whole data section in one pass
+                mocap_data, force_data = _read_frames_bulk(file_id, reader, frequency_ratio,
+                                                           point_columns, analog_columns)
+            else:
+                mocap_data = np.empty(shape=(frames, len(mocap_labels)))
+                force_frames = int(frames * (info['FP_RATE'] / info['CAMERA_RATE']))
+                force_data = np.empty(shape=(force_frames, len(force_labels)))
+                force_frame, current_frame = [int(x) for x in np.linspace(0, force_frames, num=frames + 1)], 0
+                # read in data frame by frame
+                for frame, point_frame, analog in reader.read_frames(copy=False):
+                    if frame < reader.header.first_frame or frame > reader.header.last_frame:
+                        continue
+                    mocap_data[current_frame, :] = \
+                        np.array(point_frame[:, 0:3]).reshape(-1)[point_columns]
+                    force_data[force_frame[current_frame]:force_frame[current_frame + 1], :] = \
+                        np.array(analog).reshape(frequency_ratio, n_force_labels)[:, analog_columns]
+                    current_frame += 1
             # define MoCap Data
             frame_rate = (1 / info['CAMERA_RATE'])
             n_frames = reader.last_frame() - reader.first_frame() + 1
@@ -146,3 +75,265 @@ def read_c3d(file, read_mocap=True):
     except:
         hu = 5
         return {'Error': 'Previously undiscovered error'}
+
+
+# this function reads c3d files into plain arrays, without building DataFrames or time indexes
+#   data can hold the raw bytes of the file when they were already read, e.g. by prefetch
+def read_c3d_arrays(file, points=None, analogs=None, data=None):
+    # check if file exists
+    if data is None and not os.path.exists(file):
+        return {'Error': 'File does not exist'}
+    try:
+        try:
+            file_id = open(file, 'rb') if data is None else io.BytesIO(data)
+            reader = c3d.Reader(file_id)
+        except:
+            raise ValueError('Reading Error of file')
+        info = _read_info(reader)
+        mocap_labels, point_columns, force_labels, analog_columns = \
+            _select_labels(reader, points, analogs)[:4]
+        frequency_ratio = int(info['FP_RATE'] / info['CAMERA_RATE'])
+        mocap_data, force_data = _read_frames_bulk(file_id, reader, frequency_ratio, point_columns, analog_columns)
+        # invert the plates like Vicon would do
+        grf_labels, grf_columns = _grf_columns(force_labels)
+        file_id.close()
+        return {'MoCap': mocap_data, 'MoCapLabels': mocap_labels,
+                'GRF': -force_data[:, grf_columns], 'GRFLabels': grf_labels,
+                'FirstFrame': max(reader.first_frame(), reader.header.first_frame), 'Info': info}
+    except OSError as err:
+        return {'Error': '{}'.format(err)}
+    except ValueError as err:
+        return {'Error': '{}'.format(err)}
+    except:
+        return {'Error': 'Previously undiscovered error'}
+
+
+# this function picks the force columns that are kept (and sign inverted) in the GRF output
+def _grf_columns(force_labels):
+    grf_labels = [x for x in ['Fx1', 'Fy1', 'Fz1', 'Fx2', 'Fy2', 'Fz2'] if x in force_labels]
+    return grf_labels, [force_labels.index(x) for x in grf_labels]
+
+
+# this function cleans the point and analog labels and resolves the requested channels
+def _select_labels(reader, points, analogs):
+    # get labels
+    mocap_labels = reader.point_labels
+    mocap_labels = [x.replace(' ', '') for x in mocap_labels]
+    mocap_labels = [x + axis for x in mocap_labels for axis in ['_x', '_y', '_z']]
+    force_labels = reader.get('ANALOG')
+    force_labels = force_labels.get('LABELS')
+    force_labels = force_labels.string_array
+    force_labels = [x.replace(' ', '') for x in force_labels]
+    force_labels = [x.replace('Force.', '') for x in force_labels]
+    force_labels = [x.replace('Moment.', '') for x in force_labels]
+    if len(force_labels) == 0:
+        raise ValueError('No ForcePlate Data in C3D please check file')
+    # only decode the requested channels, a point label selects all three axes
+    #   and labels missing from the file are left out
+    if points is None:
+        point_columns = list(range(len(mocap_labels)))
+    else:
+        point_columns = []
+        for label in points:
+            for axis in ['', '_x', '_y', '_z']:
+                if label + axis in mocap_labels:
+                    point_columns += [mocap_labels.index(label + axis)]
+        point_columns = sorted(set(point_columns))
+    if analogs is None:
+        analog_columns = list(range(len(force_labels)))
+    else:
+        analog_columns = sorted(set(force_labels.index(x) for x in analogs if x in force_labels))
+    n_force_labels = len(force_labels)
+    mocap_labels = [mocap_labels[x] for x in point_columns]
+    force_labels = [force_labels[x] for x in analog_columns]
+    return mocap_labels, point_columns, force_labels, analog_columns, n_force_labels
+
+
+# this function reads the header and parameter section only
+def read_c3d_info(file):
+    # check if file exists
+    if not os.path.exists(file):
+        return {'Error': 'File does not exist'}
+    try:
+        try:
+            file_id = open(file, 'rb')
+            reader = c3d.Reader(file_id)
+        except:
+            raise ValueError('Reading Error of file')
+        info = _read_info(reader)
+        file_id.close()
+        return {'Info': info}
+    except OSError as err:
+        return {'Error': '{}'.format(err)}
+    except ValueError as err:
+        return {'Error': '{}'.format(err)}
+    except:
+        return {'Error': 'Previously undiscovered error'}
+
+
+# this function collects the subject, trial and force plate info from the parameters
+def _read_info(reader):
+    # get other info
+    info = dict()
+    col_of_int = ['DATEOFCAPTURE', 'USER', 'VERSION', 'DESCRIPTION', 'NOTE']
+    ssc_info = reader.get('SSCDATAANDPROCESSING')
+    if ssc_info is None:
+        # if no processing was done at all
+        for field in col_of_int:
+            info[field] = [None]
+    else:
+        for field in col_of_int:
+            val = ssc_info.get(field)
+            if val is None:
+                info[field] = [None]
+            elif val.dimensions[0] == 0:
+                info[field] = [None]
+            else:
+                try:
+                    info[field] = val.string_array
+                except UnicodeDecodeError:
+                    if val.bytes_array[0] == b'Zhan\xe9':
+                        info[field] = 'Zhane'
+                    else:
+                        info[field] = val.string_array
+    col_of_int = ['BODYMASS', 'HEIGHT']
+    ssc_info = reader.get('PROCESSING')
+    if ssc_info is None:
+        # if no processing was done at all
+        for field in col_of_int:
+            info[field] = None
+    else:
+        for field in col_of_int:
+            val = ssc_info.get(field)
+            if val is None:
+                info[field] = None
+            elif val.dimensions[0] == 0:
+                info[field] = None
+            else:
+                info[field] = val.float_value
+    col_of_int = ['Names']
+    ssc_info = reader.get('SUBJECTS')
+    if ssc_info is None:
+        # if no processing was done at all
+        for field in col_of_int:
+            info[field] = None
+    else:
+        for field in col_of_int:
+            val = ssc_info.get(field)
+            if val is None:
+                info[field] = [None]
+            else:
+                info[field] = val.float_value
+    # reader.get('TRIAL.CAMERA_RATE').float_value
+    col_of_int = ['CAMERA_RATE']
+    ssc_info = reader.get('TRIAL')
+    for field in col_of_int:
+        val = ssc_info.get(field)
+        if val is None:
+            info[field] = None
+        else:
+            info[field] = val.float_value
+    info['FP_RATE'] = reader.get('ANALOG').get('RATE').float_value
+    # get borders of plate 1 and plate 2 to compute mid point of fp to infer
+    #   direction. Negative would imply to the right, while positive would imply to
+    #   the left
+    fp_border = reader.get('FORCE_PLATFORM')
+    fp_border = fp_border.get('CORNERS')
+    fp_border = fp_border.float_array
+    n_planes, n_points, n_plates = fp_border.shape
+    fp_border = np.array(fp_border).reshape(n_plates, n_points, n_planes)
+    for count in range(0, n_plates):
+        info['xmidposFP' + str(count + 1)] = float(fp_border[count].mean(axis=0)[0])
+    return info
+
+
+# this function works out how frames are laid out in the c3d data section
+def _frame_layout(reader):
+    header = reader.header
+    layout = dict()
+    # words per frame as stored in the file, Intel byte order only
+    layout['is_float'] = reader.point_scale < 0
+    layout['point_scale'] = 1. if layout['is_float'] else abs(reader.point_scale)
+    format_param = reader.get('ANALOG:FORMAT')
+    analog_unsigned = format_param is not None and format_param.string_value.strip().upper() == 'UNSIGNED'
+    if layout['is_float']:
+        point_dtype, analog_dtype = '<f4', '<f4'
+    else:
+        point_dtype, analog_dtype = '<i2', '<u2' if analog_unsigned else '<i2'
+    layout['frame_dtype'] = np.dtype([('points', point_dtype, (header.point_count, 4)),
+                                      ('analog', analog_dtype, (header.analog_count,))])
+    # frames are stored from first_frame() onwards, keep the ones inside the header range
+    first = max(reader.first_frame(), header.first_frame)
+    last = min(reader.last_frame(), header.last_frame)
+    layout['frames'] = last - first + 1
+    layout['data_start'] = (header.data_block - 1) * 512 + (first - reader.first_frame()) * layout['frame_dtype'].itemsize
+    # analog conversion
+    n_analog = reader.analog_used
+    layout['n_analog'] = n_analog
+    layout['offsets'] = np.zeros(n_analog, int)
+    param = reader.get('ANALOG:OFFSET')
+    if param is not None and len(param.dimensions) > 0 and param.dimensions[0] > 0:
+        layout['offsets'] = param.int16_array.reshape(-1)[:n_analog]
+    layout['scales'] = np.ones(n_analog, float)
+    param = reader.get('ANALOG:SCALE')
+    if param is not None and len(param.dimensions) > 0 and param.dimensions[0] > 0:
+        layout['scales'] = param.float_array.reshape(-1)[:n_analog]
+    layout['gen_scale'] = 1.
+    param = reader.get('ANALOG:GEN_SCALE')
+    if param is not None:
+        layout['gen_scale'] = param.float_value
+    return layout
+
+
+# this function converts raw frames into scaled point and analog arrays
+def _decode_frames(raw, layout, frequency_ratio, point_columns, analog_columns):
+    frames = len(raw)
+    # points, only the requested x y z columns are converted
+    point_columns = np.asarray(point_columns, dtype=int)
+    mocap_data = raw['points'][:, point_columns // 3, point_columns % 3].astype(float)
+    if not layout['is_float']:
+        mocap_data *= layout['point_scale']
+    # analog, samples are interleaved per channel within each frame
+    analog_columns = np.asarray(analog_columns, dtype=int)
+    force_data = raw['analog'].reshape(frames * frequency_ratio, layout['n_analog'])[:, analog_columns].astype(float)
+    force_data = (force_data - layout['offsets'][analog_columns]) * layout['scales'][analog_columns] * \
+        layout['gen_scale']
+    return mocap_data, force_data
+
+
+# this function decodes the whole c3d data section at once
+def _read_frames_bulk(file_id, reader, frequency_ratio, point_columns, analog_columns):
+    layout = _frame_layout(reader)
+    frames, frame_bytes = layout['frames'], layout['frame_dtype'].itemsize
+    file_id.seek(layout['data_start'])
+    buffer = file_id.read(frames * frame_bytes)
+    if len(buffer) < frames * frame_bytes:
+        raise ValueError('Data section shorter than the frame count in the header')
+    raw = np.frombuffer(buffer, dtype=layout['frame_dtype'], count=frames)
+    return _decode_frames(raw, layout, frequency_ratio, point_columns, analog_columns)
+
+
+# this function reads a c3d in blocks of chunk_frames frames so memory use does not grow with the capture length
+def iter_c3d_chunks(file, chunk_frames=1000, points=None, analogs=None):
+    with open(file, 'rb') as file_id:
+        reader = c3d.Reader(file_id)
+        camera_rate = reader.get('TRIAL').get('CAMERA_RATE').float_value
+        frequency_ratio = int(reader.get('ANALOG').get('RATE').float_value / camera_rate)
+        mocap_labels, point_columns, force_labels, analog_columns = \
+            _select_labels(reader, points, analogs)[:4]
+        # invert the plates like Vicon would do, only the force columns are kept like in read_c3d
+        grf_labels, grf_columns = _grf_columns(force_labels)
+        layout = _frame_layout(reader)
+        frame_bytes = layout['frame_dtype'].itemsize
+        first_time = (max(reader.first_frame(), reader.header.first_frame) - 1) / camera_rate
+        for start in range(0, layout['frames'], chunk_frames):
+            frames = min(chunk_frames, layout['frames'] - start)
+            file_id.seek(layout['data_start'] + start * frame_bytes)
+            buffer = file_id.read(frames * frame_bytes)
+            if len(buffer) < frames * frame_bytes:
+                raise ValueError('Data section shorter than the frame count in the header')
+            raw = np.frombuffer(buffer, dtype=layout['frame_dtype'], count=frames)
+            mocap_data, force_data = _decode_frames(raw, layout, frequency_ratio, point_columns, analog_columns)
+            yield {'Frame': start, 'Time': first_time + start / camera_rate,
+                   'MoCap': mocap_data, 'MoCapLabels': mocap_labels,
+                   'GRF': -force_data[:, grf_columns], 'GRFLabels': grf_labels}
@@ -0,0 +1,86 @@
+import csv
+import os
+
+from metrics import table_names
+
+
+def _parquet_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ResultsSink:
+    # Writes trial and patient rows of every output table as they are finished, so memory doesn't grow with the
+    # cohort and a run that stops part way still leaves everything finished so far on disk. CSV tables are appended
+    # to row by row, Parquet tables are folders with one part file per patient (pd.read_parquet reads the folder)
+    def __init__(self, out_dir, format=None):
+        self.out_dir = out_dir
+        self.format = format or ("parquet" if _parquet_available() else "csv")
+        self.parts = 0
+        os.makedirs(out_dir, exist_ok=True)
+        # A new run starts from empty tables
+        for name in self.tables() + ["errors"]:
+            path = self._path(name)
+            if os.path.isdir(path):
+                for part in os.listdir(path):
+                    os.remove(os.path.join(path, part))
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def tables(self):
+        return ["patients_" + table for table in table_names] + ["trials_" + table for table in table_names]
+
+    def _path(self, name):
+        return os.path.join(self.out_dir, name + (".csv" if self.format == "csv" or name == "errors" else ""))
+
+    def _append(self, name, rows):
+        if not rows:
+            return
+        path = self._path(name)
+        if self.format == "csv" or name == "errors":
+            new = not os.path.exists(path)
+            with open(path, "a", newline="", encoding="utf-8") as file:
+                writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+                if new:
+                    writer.writeheader()
+                writer.writerows(rows)
+        else:
+            import pandas as pd
+
+            os.makedirs(path, exist_ok=True)
+            pd.DataFrame(rows).to_parquet(os.path.join(path, "part-{:05d}.parquet".format(self.parts)), index=False)
+
+    def write_patient(self, patient, files, trial_rows, patient_rows):
+        # trial_rows holds the metric_rows of every trial in files, patient_rows the averageTrials of each table
+        for table in table_names:
+            self._append("trials_" + table, [dict({"Patient": patient, "Trial": os.path.basename(file)}, **row[table])
+                                             for file, row in zip(files, trial_rows)])
+            if patient_rows.get(table):
+                self._append("patients_" + table, [patient_rows[table]])
+        self.parts += 1
+
+    def write_error(self, patient, error):
+        self._append("errors", [{"Patient": patient, "Error": error}])
+
+    def read(self, name):
+        # Whole table as a DataFrame, also usable on the output of an unfinished run
+        import pandas as pd
+
+        path = self._path(name)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        if self.format == "csv" or name == "errors":
+            return pd.read_csv(path, encoding="utf-8")
+        parts = sorted(os.listdir(path))
+        return pd.concat([pd.read_parquet(os.path.join(path, part)) for part in parts], ignore_index=True)
+
+    def to_excel(self, excel_path, tables=None):
+        # One sheet per table, built from the stored tables once the run is done
+        import pandas as pd
+
+        with pd.ExcelWriter(excel_path) as writer:
+            for name in tables or self.tables() + ["errors"]:
+                self.read(name).to_excel(writer, sheet_name=name, index=False)
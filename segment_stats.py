@@ -0,0 +1,51 @@
+import numpy as np
+
+stat_names = ["max", "min", "mean", "impulse"]
+
+
+def reduce_segments(data, windows, dx=1.0):
+    # Max, min, mean and trapezoid impulse of every channel over every inclusive (start, end) window.
+    # data is (samples x channels), windows is (phases x 2), the result is (channels x phases x stats).
+    # NaNs are skipped for max/min/mean like pandas does, and make the impulse NaN like np.trapz does
+    data = np.asarray(data, dtype=float)
+    if data.ndim == 1:
+        data = data[:, None]
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 2)
+    n_samples, n_channels = data.shape
+    starts = np.clip(windows[:, 0], 0, n_samples)
+    stops = np.maximum(np.clip(windows[:, 1] + 1, 0, n_samples), starts)  # Exclusive end
+    lengths = stops - starts
+    empty = lengths == 0
+
+    # Max and min: reduceat over interleaved (start, stop) pairs, the even results are the windows. A NaN row is
+    # appended so a window ending on the last sample still has a valid stop index
+    padded = np.vstack([data, np.full((1, n_channels), np.nan)])
+    bounds = np.empty(2 * len(windows), dtype=np.int64)
+    bounds[0::2] = starts
+    bounds[1::2] = stops
+    maxima = np.fmax.reduceat(padded, bounds, axis=0)[0::2]
+    minima = np.fmin.reduceat(padded, bounds, axis=0)[0::2]
+    maxima[empty] = np.nan
+    minima[empty] = np.nan
+
+    # Mean and impulse: window sums from prefix sums of the NaN-free data, plus a running count of NaNs
+    is_nan = np.isnan(data)
+    prefix = np.zeros((n_samples + 1, n_channels))
+    np.cumsum(np.where(is_nan, 0.0, data), axis=0, out=prefix[1:])
+    nan_prefix = np.zeros((n_samples + 1, n_channels), dtype=np.int64)
+    np.cumsum(is_nan, axis=0, out=nan_prefix[1:])
+    sums = prefix[stops] - prefix[starts]
+    nans = nan_prefix[stops] - nan_prefix[starts]
+    counts = lengths[:, None] - nans
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / counts, np.nan)
+
+    # Trapezoid rule: every sample counts fully except the two end samples, which count half
+    first = padded[np.minimum(starts, n_samples)]
+    last = padded[np.maximum(stops - 1, 0)]
+    impulses = dx * (sums - 0.5 * (first + last))
+    impulses[lengths < 2] = 0.0
+    impulses[(nans > 0) & (lengths[:, None] >= 2)] = np.nan
+
+    stats = np.stack([maxima, minima, means, impulses], axis=-1)  # phases x channels x stats
+    return stats.transpose(1, 0, 2)
@@ -0,0 +1,84 @@
+import numpy as np
+
+# Phase boundaries of one trial. Everything is a mocap sample index except landing_start_force, which is the
+# force sample of the GRF minimum that starts the landing (it usually falls between two mocap frames)
+phase_dtype = np.dtype([("ED_start", np.int64), ("ED_end", np.int64), ("con_end", np.int64),
+                        ("top_of_flight", np.int64), ("landing_start", np.int64), ("landing_start_force", np.int64),
+                        ("landing_end", np.int64)])
+
+phase_names = ["ED", "Con", "Landing"]
+
+
+def _first(mask, start, stop, default):
+    # First index in [start, stop) where mask is True, default where there is none
+    cols = np.arange(mask.shape[1])
+    mask = mask & (cols >= start[:, None]) & (cols < stop[:, None])
+    return np.where(mask.any(axis=1), mask.argmax(axis=1), default)
+
+
+def _arg(values, start, stop, find_max):
+    # NaN-skipping argmax/argmin over [start, stop) of every row
+    cols = np.arange(values.shape[1])
+    inside = (cols >= start[:, None]) & (cols < stop[:, None]) & ~np.isnan(values)
+    if find_max:
+        found = np.where(inside, values, -np.inf).argmax(axis=1)
+    else:
+        found = np.where(inside, values, np.inf).argmin(axis=1)
+    return np.where(inside.any(axis=1), found, start)
+
+
+def segment_cmj_batch(com_vel_z, grf_total, ratio, vel_lengths=None, grf_lengths=None):
+    # com_vel_z is (trials x mocap samples) in m/s and grf_total (trials x force samples), shorter trials padded at
+    # the end. ratio is the number of force samples per mocap frame, so mocap sample i lines up with force i * ratio
+    com_vel_z = np.atleast_2d(np.asarray(com_vel_z, dtype=float))
+    grf_total = np.atleast_2d(np.asarray(grf_total, dtype=float))
+    n_trials, n_vel = com_vel_z.shape
+    if vel_lengths is None:
+        vel_lengths = np.full(n_trials, n_vel)
+    if grf_lengths is None:
+        grf_lengths = np.full(n_trials, grf_total.shape[1])
+    vel_lengths = np.asarray(vel_lengths)
+    grf_lengths = np.asarray(grf_lengths)
+    zeros = np.zeros(n_trials, dtype=np.int64)
+    positive = com_vel_z >= 0
+
+    # Takeoff is the highest velocity of the trial
+    max_velocity = _arg(com_vel_z, zeros, vel_lengths, True)
+
+    # Eccentric Deceleration Phase (Max neg-vel to zero), lowest vel before takeoff to the first zero after it
+    ED_start = _arg(com_vel_z, zeros, max_velocity + 1, False)
+    ED_end = _first(positive, ED_start, max_velocity + 1, ED_start)
+
+    # Landing Phase (Landing to Zero vel), mid-point of flight where vel = 0, then the GRF minimum after it
+    top_of_flight = _first(~positive, max_velocity, vel_lengths, max_velocity)
+    landing_start_force = _arg(grf_total, top_of_flight * ratio, grf_lengths, False)
+    landing_start = -(-landing_start_force // ratio)  # First mocap frame at or after the GRF minimum
+    if np.any(landing_start >= vel_lengths):
+        raise ValueError("Landing starts after the end of the motion capture data")
+    landing_end = _first(positive, landing_start, vel_lengths, landing_start)
+
+    phases = np.empty(n_trials, dtype=phase_dtype)
+    phases["ED_start"] = ED_start
+    phases["ED_end"] = ED_end
+    phases["con_end"] = max_velocity
+    phases["top_of_flight"] = top_of_flight
+    phases["landing_start"] = landing_start
+    phases["landing_start_force"] = landing_start_force
+    phases["landing_end"] = landing_end
+    return phases
+
+
+def segment_cmj(com_vel_z, grf_total, ratio):
+    return segment_cmj_batch(com_vel_z, grf_total, ratio)[0]
+
+
+def phase_windows(phases, ratio):
+    # Inclusive (start, end) sample windows of ED, Con and Landing, as (trials x phases x 2) arrays for the mocap
+    # and force data. Concentric runs from the end of ED (zero vel) to takeoff
+    phases = np.atleast_1d(phases)
+    mocap = np.stack([np.stack([phases["ED_start"], phases["ED_end"]], axis=-1),
+                      np.stack([phases["ED_end"], phases["con_end"]], axis=-1),
+                      np.stack([phases["landing_start"], phases["landing_end"]], axis=-1)], axis=1)
+    force = mocap * ratio
+    force[:, 2, 0] = phases["landing_start_force"]
+    return mocap, force
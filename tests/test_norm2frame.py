@@ -0,0 +1,53 @@
+import numpy as np
+
+from norm2frame import norm2frame, norm2frame_batch, norm2frame_segments
+
+
+def _per_column(segment, frame):
+    # Reference: norm2frame on every channel of one segment
+    segment = np.asarray(segment, dtype=float)
+    if segment.ndim == 1:
+        return norm2frame(segment, frame)
+    return np.stack([norm2frame(segment[:, column], frame) for column in range(segment.shape[1])], axis=1)
+
+
+def test_batch_1d():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=57)
+    np.testing.assert_allclose(norm2frame_batch(data, 101), norm2frame(data, 101))
+
+
+def test_batch_2d():
+    rng = np.random.default_rng(1)
+    data = rng.normal(size=(57, 3))
+    np.testing.assert_allclose(norm2frame_batch(data, 101), _per_column(data, 101))
+
+
+def test_batch_3d():
+    rng = np.random.default_rng(2)
+    data = rng.normal(size=(4, 57, 3))
+    expected = np.stack([_per_column(trial, 101) for trial in data])
+    np.testing.assert_allclose(norm2frame_batch(data, 101), expected)
+
+
+def test_batch_list_of_1d_segments_of_different_lengths():
+    rng = np.random.default_rng(3)
+    segments = [rng.normal(size=length) for length in [20, 35, 20, 48]]
+    expected = np.stack([norm2frame(segment, 101) for segment in segments])
+    np.testing.assert_allclose(norm2frame_batch(segments, 101), expected)
+
+
+def test_batch_list_of_2d_segments_of_different_lengths():
+    rng = np.random.default_rng(4)
+    segments = [rng.normal(size=(length, 3)) for length in [20, 35, 20, 48]]
+    expected = np.stack([_per_column(segment, 101) for segment in segments])
+    np.testing.assert_allclose(norm2frame_batch(segments, 101), expected)
+
+
+def test_segments_1d_and_2d():
+    rng = np.random.default_rng(5)
+    data = rng.normal(size=(200, 2))
+    windows = [(0, 40), (40, 119), (150, 199)]
+    expected = np.stack([_per_column(data[start:end + 1], 51) for start, end in windows])
+    np.testing.assert_allclose(norm2frame_segments(data, windows, 51), expected)
+    np.testing.assert_allclose(norm2frame_segments(data[:, 0], windows, 51), expected[:, :, 0])
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import main
+from bench import write_trial
+from force_plate import force_spec, measure_force
+from metrics import evaluate_metrics, metric_rows
+from online import replay
+from trial import read_trial
+
+
+def _offline(file):
+    # var_outputs of the force_only pipeline, as calcTrial gives them
+    trial = read_trial(file, points=[], analogs=main.force_channels)
+    stats, v_takeoff = measure_force(trial, main.force_plan["channels"])
+    tables = evaluate_metrics(main.force_plan, stats[None], [v_takeoff], ["Right"])
+    return metric_rows(main.force_plan, tables)["var_outputs"]
+
+
+@pytest.mark.parametrize("chunk_frames", [1, 7])
+@pytest.mark.parametrize("seed", range(6))
+def test_replay_matches_offline(tmp_path, seed, chunk_frames):
+    file = write_trial(str(tmp_path / "CMJ 1.c3d"), mass=60.0 + 5 * seed, quiet=0.8 + 0.1 * seed, seed=seed)
+    offline = _offline(file)
+
+    online = {}
+    events = replay(file, force_spec(main.metric_spec), chunk_frames=chunk_frames)
+    for event in events:
+        online.update(event["metrics"])
+
+    assert [event["phase"] for event in events] == ["Quiet", "Unweighting", "ED", "Con", "Flight", "Landing"]
+    assert set(offline) <= set(online)
+    for name, value in offline.items():
+        np.testing.assert_allclose(online[name], value, rtol=1e-9, atol=1e-9, err_msg=name)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from bench import write_trial
+from read_c3d import read_c3d, read_c3d_arrays, iter_c3d_chunks
+
+selections = [(None, None), (["CentreOfMass_z", "COMVelocity", "RKneeMoment_x", "Missing"], ["Fz1", "Fz2", "Mx1"])]
+
+
+@pytest.fixture(params=[-0.1, 0.1], ids=["float", "int16"])
+def trial_file(request, tmp_path):
+    # A negative point_scale stores floats, a positive one int16
+    return write_trial(str(tmp_path / "CMJ 1.c3d"), extra_points=3, point_scale=request.param, seed=3)
+
+
+@pytest.mark.parametrize("points, analogs", selections)
+def test_bulk_matches_frame_by_frame(trial_file, points, analogs):
+    bulk = read_c3d(trial_file, points=points, analogs=analogs)
+    frames = read_c3d(trial_file, bulk=False, points=points, analogs=analogs)
+    assert "Error" not in bulk and "Error" not in frames
+    pd.testing.assert_frame_equal(bulk["MoCap"], frames["MoCap"], check_exact=True)
+    pd.testing.assert_frame_equal(bulk["GRF"], frames["GRF"], check_exact=True)
+
+
+@pytest.mark.parametrize("points, analogs", selections)
+def test_arrays_and_chunks_match_read_c3d(trial_file, points, analogs):
+    frames = read_c3d(trial_file, bulk=False, points=points, analogs=analogs)
+    arrays = read_c3d_arrays(trial_file, points=points, analogs=analogs)
+    assert arrays["MoCapLabels"] == list(frames["MoCap"].columns)
+    assert arrays["GRFLabels"] == list(frames["GRF"].columns)
+    np.testing.assert_array_equal(arrays["MoCap"], frames["MoCap"].values)
+    np.testing.assert_array_equal(arrays["GRF"], frames["GRF"].values)
+
+    chunks = list(iter_c3d_chunks(trial_file, 7, points=points, analogs=analogs))  # 7 doesn't divide the frames
+    assert [chunk["Frame"] for chunk in chunks] == list(range(0, len(arrays["MoCap"]), 7))
+    np.testing.assert_array_equal(np.concatenate([chunk["MoCap"] for chunk in chunks]), arrays["MoCap"])
+    np.testing.assert_array_equal(np.concatenate([chunk["GRF"] for chunk in chunks]), arrays["GRF"])
@@ -0,0 +1,85 @@
+import numpy as np
+
+from read_c3d import read_c3d_arrays
+
+
+class Trial:
+    # One CMJ trial as two contiguous sample x channel blocks, mocap at CAMERA_RATE and force at FP_RATE.
+    # Samples are addressed by integer index, DataFrames are only built when asked for
+    __slots__ = ("path", "mocap", "grf", "mocap_columns", "grf_columns", "mocap_rate", "force_rate",
+                 "first_frame", "info")
+
+    def __init__(self, mocap, mocap_labels, grf, grf_labels, mocap_rate, force_rate, first_frame=1, info=None,
+                 path=None, dtype=None):
+        self.path = path
+        self.mocap = np.ascontiguousarray(mocap, dtype=dtype)
+        self.grf = np.ascontiguousarray(grf, dtype=dtype)
+        self.mocap_columns = {label: column for column, label in enumerate(mocap_labels)}
+        self.grf_columns = {label: column for column, label in enumerate(grf_labels)}
+        self.mocap_rate = mocap_rate
+        self.force_rate = force_rate
+        self.first_frame = first_frame
+        self.info = info if info is not None else {}
+
+    @property
+    def ratio(self):
+        # Force samples per mocap frame
+        return int(self.force_rate / self.mocap_rate)
+
+    @property
+    def nbytes(self):
+        return self.mocap.nbytes + self.grf.nbytes
+
+    def __contains__(self, label):
+        return label in self.mocap_columns or label in self.grf_columns
+
+    def channel(self, label):
+        # A view of one mocap or force channel
+        if label in self.mocap_columns:
+            return self.mocap[:, self.mocap_columns[label]]
+        return self.grf[:, self.grf_columns[label]]
+
+    def mocap_time(self, sample):
+        return (self.first_frame - 1 + np.asarray(sample)) / self.mocap_rate
+
+    def force_time(self, sample):
+        return (self.first_frame - 1 + np.asarray(sample) / self.ratio) / self.mocap_rate
+
+    def mocap_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.mocap, columns=list(self.mocap_columns),
+                            index=self.mocap_time(np.arange(len(self.mocap))), copy=False)
+
+    def grf_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.grf, columns=list(self.grf_columns),
+                            index=self.force_time(np.arange(len(self.grf))), copy=False)
+
+    @classmethod
+    def from_read_c3d(cls, data, path=None, dtype=None):
+        # Wraps the DataFrame output of read_c3d/read_c3d_cached
+        info = data["Info"]
+        first_frame = int(round(data["MoCap"].index[0] * info["CAMERA_RATE"])) + 1 if len(data["MoCap"]) else 1
+        return cls(data["MoCap"].to_numpy(), list(data["MoCap"].columns), data["GRF"].to_numpy(),
+                   list(data["GRF"].columns), info["CAMERA_RATE"], info["FP_RATE"], first_frame, info, path, dtype)
+
+
+def read_trial(file, points=None, analogs=None, dtype=None, cache_dir=None, data=None):
+    # Reads a c3d straight into a Trial, dtype=np.float32 halves the memory of the data blocks. data is the raw bytes
+    # of the file if they were already read, a cache hit doesn't need them
+    if cache_dir:
+        from c3d_cache import read_c3d_cached
+
+        data = read_c3d_cached(file, cache_dir, read_mocap=True, points=points, analogs=analogs)
+        if "Error" in data:
+            raise ValueError("{}: {}".format(file, data["Error"]))
+        return Trial.from_read_c3d(data, file, dtype)
+
+    data = read_c3d_arrays(file, points=points, analogs=analogs, data=data)
+    if "Error" in data:
+        raise ValueError("{}: {}".format(file, data["Error"]))
+    info = data["Info"]
+    return Trial(data["MoCap"], data["MoCapLabels"], data["GRF"], data["GRFLabels"], info["CAMERA_RATE"],
+                 info["FP_RATE"], data["FirstFrame"], info, file, dtype)